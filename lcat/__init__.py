@@ -6,4 +6,8 @@ from __future__ import absolute_import
 from .analysis import *
 from .loading import *
 from .segmentation import *
+from . import cache
+from . import instrumentation
+from . import masks
+from . import shared
 from . import util
@@ -3,4 +3,7 @@ Analysis package of the Lung Cancer Action Team toolkit.
 """
 from __future__ import absolute_import
 
-from .tracheal_distance import get_tracheal_distances
+from .airway_graph import get_airway_distances, get_airway_graph, get_nodule_airway_distances
+from .body_depth import get_nodule_body_depths
+from .nodule_statistics import get_nodule_labels, get_nodule_statistics
+from .tracheal_distance import get_nodule_tracheal_distances, get_tracheal_distances
@@ -0,0 +1,303 @@
+"""
+Airway skeleton graph for repeated tracheal distance queries.
+"""
+from __future__ import division
+from collections import namedtuple
+import sys
+
+import numpy as np
+import scipy.sparse
+import scipy.sparse.csgraph
+import skimage.morphology
+
+import lcat
+import lcat.cache
+import lcat.instrumentation
+import lcat.masks
+from . import tracheal_distance
+
+
+# Airway graph datatype
+# `shape` and `unit_cell` describe the scan, `origin` and `domain` the air reachable from the
+# trachea (as in `lcat.analysis.tracheal_distance.AirwayDomain`), `coordinates` the index of each
+# skeleton voxel within `domain` and `distances` the distance (in physical units) from the top of
+# the trachea to each skeleton voxel through the airway
+AirwayGraph = namedtuple('AirwayGraph', ['shape', 'unit_cell', 'origin', 'domain', 'coordinates',
+                                         'distances'])
+
+# Query region datatype (a binary `mask` placed at index `origin` within the scan)
+Region = namedtuple('Region', ['origin', 'mask'])
+
+# Version of the airway graph algorithm (increment when changing results)
+AIRWAY_GRAPH_VERSION = 3
+
+# Initial padding (in voxels) of the window around a query region in which local hops are computed
+AIRWAY_GRAPH_HOP_PADDING = 8
+
+
+@lcat.instrumentation.instrumented()
+def get_airway_graph(scan, lung_segmentation, cache_folder=None):
+    """
+    Extract the centerline skeleton of the air within the lungs that is reachable from the trachea,
+    and compute the distance from the top of the trachea to every skeleton voxel. Returns an
+    `AirwayGraph`, which can be queried using `get_airway_distances` and
+    `get_nodule_airway_distances` without solving another fast marching problem.
+    `lung_segmentation` may be a dense array or a `lcat.masks.PackedMask`.
+
+    The graph is persisted if a cache folder is configured (see `lcat.cache.get_cache_folder`),
+    keyed by the voxels of `scan` and the contents of `lung_segmentation`.
+    """
+    # Look for a cached graph
+    cache_folder = lcat.cache.get_cache_folder(cache_folder)
+    path = None
+    if cache_folder is not None:
+        key = lcat.cache.get_key('airway_graph', AIRWAY_GRAPH_VERSION,
+                                 lcat.cache.get_scan_fingerprint(scan),
+                                 lcat.cache.get_mask_fingerprint(lung_segmentation))
+        path = lcat.cache.get_cache_path(cache_folder, 'airway_graph', key)
+        arrays = lcat.cache.load_arrays(path)
+        if arrays is not None:
+            domain = lcat.masks.PackedMask(arrays['domain_bits'], arrays['domain_shape'])
+            return AirwayGraph(tuple(int(dim) for dim in arrays['shape']), arrays['unit_cell'],
+                               tuple(int(start) for start in arrays['origin']), domain.to_dense(),
+                               arrays['coordinates'], arrays['distances'])
+
+    # Compute the graph
+    graph = compute_airway_graph(scan, lung_segmentation)
+
+    # Store the graph
+    if path is not None:
+        domain = lcat.masks.pack(graph.domain)
+        lcat.cache.save_arrays(path, shape=np.asarray(graph.shape), unit_cell=graph.unit_cell,
+                               origin=np.asarray(graph.origin), domain_bits=domain.bits,
+                               domain_shape=np.asarray(domain.shape),
+                               coordinates=graph.coordinates, distances=graph.distances)
+
+    return graph
+
+
+def compute_airway_graph(scan, lung_segmentation):
+    """
+    Compute the `AirwayGraph` of `scan` for `get_airway_graph`. The distance of each skeleton voxel
+    is read from a single fast marching solution over the airway (as computed by
+    `lcat.analysis.tracheal_distance.get_tracheal_distances`).
+    """
+    # Lazy-load skfmm
+    try:
+        import skfmm
+    except ImportError:
+        print("Airway graph construction requires scikit-fmm to be installed. Please execute "
+              "`pip install scikit-fmm`.")
+        sys.exit(1)
+
+    # Identify the air reachable from the trachea
+    airway = tracheal_distance.get_airway_domain(scan, lung_segmentation)
+
+    # Extract the centerline skeleton
+    coordinates = np.argwhere(skeletonize(airway.domain))
+    if len(coordinates) == 0:
+        raise Exception("Airway skeleton is empty")
+
+    # Compute distances from the top of the trachea over the airway
+    unit_cell = np.asarray(scan.unit_cell, dtype=np.float64)
+    distances = tracheal_distance.march(skfmm, airway.domain, airway.seed, dx=unit_cell)
+
+    # Keep the skeleton voxels which can be reached
+    reached = np.logical_not(np.ma.getmaskarray(distances)[tuple(coordinates.T)])
+    coordinates = coordinates[reached]
+    distances = np.ma.getdata(distances)[tuple(coordinates.T)]
+
+    return AirwayGraph(tuple(scan.voxels.shape), unit_cell, tuple(airway.origin), airway.domain,
+                       coordinates, distances)
+
+
+def skeletonize(mask):
+    """
+    Return the 3D skeleton of the binary array `mask`.
+    """
+    # Older versions of scikit-image only provide 3D skeletonization as skeletonize_3d
+    skeletonize_3d = getattr(skimage.morphology, 'skeletonize_3d', None)
+    if skeletonize_3d is None:
+        return skimage.morphology.skeletonize(mask).astype(bool)
+
+    return skeletonize_3d(mask).astype(bool)
+
+
+def get_voxel_graph(mask, unit_cell):
+    """
+    Build a sparse directed graph connecting each voxel of the binary array `mask` to its
+    26-neighbors within `mask`, weighted by their physical distance (for the given `unit_cell`).
+    Nodes are numbered in the order of `np.argwhere(mask)`. Diagonal steps are only included if the
+    voxels they cut across are within `mask` as well, so that paths never squeeze between voxels
+    which only touch along an edge or at a corner (which fast marching can't pass either).
+    """
+    # Number the voxels of the mask
+    numbers = np.full(mask.shape, -1, dtype=np.intp)
+    numbers[mask] = np.arange(np.count_nonzero(mask))
+
+    # Edge placeholders
+    sources = []
+    destinations = []
+    weights = []
+
+    # For each neighbor offset
+    for offset in np.ndindex(3, 3, 3):
+        offset = np.asarray(offset) - 1
+        if not np.any(offset):
+            continue
+
+        # Find neighboring voxel pairs within the mask
+        source_slicer = get_shift_slicer(offset, mask.shape, np.zeros_like(offset))
+        destination_slicer = get_shift_slicer(offset, mask.shape, offset)
+        present = mask[source_slicer] & mask[destination_slicer]
+
+        # Require the voxels cut across by diagonal steps
+        for partial in np.ndindex(*(np.abs(offset) + 1)):
+            partial = np.asarray(partial) * offset
+            if np.any(partial) and np.any(partial != offset):
+                present &= mask[get_shift_slicer(offset, mask.shape, partial)]
+
+        # Store edges
+        length = np.sqrt(np.sum((offset * unit_cell) ** 2))
+        sources.append(numbers[source_slicer][present])
+        destinations.append(numbers[destination_slicer][present])
+        weights.append(np.full(np.count_nonzero(present), length))
+
+    # Assemble sparse graph
+    sources = np.concatenate(sources)
+    destinations = np.concatenate(destinations)
+    weights = np.concatenate(weights)
+
+    node_count = np.count_nonzero(mask)
+    return scipy.sparse.csr_matrix((weights, (sources, destinations)),
+                                   shape=(node_count, node_count))
+
+
+def get_shift_slicer(offset, shape, shift):
+    """
+    Return a slicer selecting, for every voxel of an array of the given `shape` whose neighbor at
+    `offset` lies within the array, the voxel at `shift` from it.
+    """
+    return tuple(slice(max(-step, 0) + moved, dim - max(step, 0) + moved)
+                 for step, dim, moved in zip(offset, shape, shift))
+
+
+@lcat.instrumentation.instrumented()
+def get_airway_distances(graph, coordinates):
+    """
+    Given an `AirwayGraph` and an (N, 3) array of scan index `coordinates` of the points of a single
+    region (such as a biopsy target), return the airway distance from the top of the trachea to
+    each point (see `get_region_airway_distances`). Points of distant regions should be queried
+    separately.
+    """
+    # Rasterize the points
+    coordinates = np.reshape(np.asarray(coordinates, dtype=np.intp), (-1, 3))
+    if len(coordinates) == 0:
+        return np.zeros(0)
+    start = np.min(coordinates, axis=0)
+    mask = np.zeros(np.max(coordinates, axis=0) - start + 1, dtype=bool)
+    mask[tuple((coordinates - start).T)] = True
+
+    # Query the region
+    region_distances = get_region_airway_distances(graph, Region(start, mask))
+
+    # Restore the order of the points
+    mask_ranks = np.cumsum(mask.ravel()) - 1
+    return region_distances[mask_ranks[np.ravel_multi_index((coordinates - start).T, mask.shape)]]
+
+
+@lcat.instrumentation.instrumented()
+def get_nodule_airway_distances(graph, nodule):
+    """
+    Given an `AirwayGraph` and a nodule, return the airway distance from the top of the trachea to
+    each voxel of the nodule mask (see `get_region_airway_distances`).
+    """
+    # Restrict the nodule to the scan
+    origin = np.asarray(nodule.origin)
+    start = np.maximum(origin, 0)
+    end = np.maximum(np.minimum(origin + nodule.mask.shape, graph.shape), start)
+    mask_slicer = tuple(slice(begin, stop) for begin, stop in zip(start - origin, end - origin))
+
+    return get_region_airway_distances(graph, Region(start, nodule.mask[mask_slicer]))
+
+
+def get_region_airway_distances(graph, region):
+    """
+    Given an `AirwayGraph` and a `Region` (or a `lcat.util.NoduleView`) within the scan, return the
+    airway distance from the top of the trachea to each voxel of the region mask. Voxels outside
+    the airway are assigned the distance of the nearest airway voxel, as in
+    `lcat.analysis.tracheal_distance.get_nodule_tracheal_distances`.
+
+    Each distance is the distance of a skeleton voxel near the region plus the length of the
+    shortest path from that skeleton voxel to the airway voxel through neighboring airway voxels
+    (see `get_voxel_graph`), minimized over the skeleton voxels. This local hop is solved exactly
+    (using Dijkstra's algorithm) within a window around the region, which grows until it contains a
+    skeleton voxel connected to every airway voxel of the region.
+    """
+    # Identify the nearest airway voxel of each region voxel
+    targets = tracheal_distance.get_nearest_airway_indices(region, graph, graph.shape,
+                                                           graph.unit_cell)
+    if len(targets) == 0:
+        return np.zeros(0)
+
+    # Determine target extents
+    target_coordinates = np.column_stack(np.unravel_index(targets, graph.domain.shape))
+    target_start = np.min(target_coordinates, axis=0)
+    target_end = np.max(target_coordinates, axis=0) + 1
+
+    # Grow window until every target is connected to the skeleton
+    padding = AIRWAY_GRAPH_HOP_PADDING
+    while True:
+        # Determine window (clipped to the airway domain)
+        window_start = np.maximum(target_start - padding, 0)
+        window_end = np.minimum(target_end + padding, graph.domain.shape)
+        covers_domain = np.all(window_start == 0) and np.all(window_end == graph.domain.shape)
+
+        # Compute hops from the skeleton voxels within the window
+        distances = get_hop_distances(graph, window_start, window_end, target_coordinates)
+        if np.all(np.isfinite(distances)):
+            return distances
+
+        # Give up once the window covers the whole airway
+        if covers_domain:
+            raise Exception("Airway voxels not connected to the airway skeleton")
+
+        padding *= 2
+
+
+def get_hop_distances(graph, window_start, window_end, target_coordinates):
+    """
+    Compute the shortest combination of skeleton voxel distance and path through the airway voxels
+    of the window between `window_start` and `window_end` (in `graph.domain` indices) to each
+    airway voxel in `target_coordinates`. Returns `np.inf` for targets which can't be reached from
+    a skeleton voxel within the window.
+    """
+    # Select skeleton voxels within the window
+    inside = np.all((graph.coordinates >= window_start) & (graph.coordinates < window_end), axis=1)
+    if not np.any(inside):
+        return np.full(len(target_coordinates), np.inf)
+
+    # Number the airway voxels of the window
+    window_slicer = tuple(slice(start, end) for start, end in zip(window_start, window_end))
+    window = graph.domain[window_slicer]
+    voxel_numbers = np.cumsum(window.ravel()) - 1
+
+    # Identify the skeleton voxels among the airway voxels of the window
+    skeleton_numbers = voxel_numbers[np.ravel_multi_index(
+        (graph.coordinates[inside] - window_start).T, window.shape)]
+
+    # Connect an additional source node to the skeleton voxels by their distances
+    voxel_graph = get_voxel_graph(window, graph.unit_cell).tocoo()
+    source = voxel_graph.shape[0]
+    rows = np.concatenate([voxel_graph.row, np.full(len(skeleton_numbers), source)])
+    columns = np.concatenate([voxel_graph.col, skeleton_numbers])
+    weights = np.concatenate([voxel_graph.data, graph.distances[inside]])
+    hop_graph = scipy.sparse.csr_matrix((weights, (rows, columns)), shape=(source + 1, source + 1))
+
+    # Find shortest paths from the source node
+    distances = scipy.sparse.csgraph.dijkstra(hop_graph, directed=True, indices=source)
+
+    # Select targets
+    target_numbers = voxel_numbers[np.ravel_multi_index((target_coordinates - window_start).T,
+                                                        window.shape)]
+    return distances[target_numbers]
@@ -0,0 +1,79 @@
+"""
+Body depth of nodule voxels, computed locally around each nodule.
+"""
+from __future__ import division
+
+import numpy as np
+import scipy.ndimage
+
+import lcat.instrumentation
+import lcat.masks
+import lcat.util
+
+
+# Initial padding (in voxels) of the window searched around each nodule
+BODY_DEPTH_INITIAL_PADDING = 16
+
+
+@lcat.instrumentation.instrumented()
+def get_nodule_body_depths(scan, body_segmentation):
+    """
+    Given a scan and its body segmentation (dense or as a `lcat.masks.PackedMask`), return a list
+    containing, for each nodule, the distance (in physical units) from each voxel of the nodule
+    mask (clipped to the scan) to the outside of the body.
+    """
+    return [get_body_depths(lcat.util.get_nodule_view(nodule, scan.voxels), body_segmentation,
+                            scan.unit_cell)
+            for nodule in scan.nodules]
+
+
+def get_body_depths(nodule, body_segmentation, unit_cell):
+    """
+    Given a `lcat.util.NoduleView` and a body segmentation with the given `unit_cell`, return the
+    physical distance from each voxel of the nodule mask to the outside of the body. The distance
+    transform is computed in a window around the nodule, which grows until it is guaranteed to
+    contain the nearest voxel outside of the body, so the result equals that of a distance transform
+    of the full body segmentation.
+    """
+    # Determine voxel spacing
+    spacing = np.asarray(unit_cell, dtype=np.float64)
+
+    # Determine nodule extents
+    shape = np.asarray(body_segmentation.shape)
+    nodule_start = np.asarray(nodule.origin)
+    nodule_end = nodule_start + nodule.mask.shape
+
+    # Grow window until the nearest voxels outside of the body are found
+    padding = BODY_DEPTH_INITIAL_PADDING
+    while True:
+        # Determine window (clipped to the scan)
+        window_start = np.maximum(nodule_start - padding, 0)
+        window_end = np.minimum(nodule_end + padding, shape)
+        covers_scan = np.all(window_start == 0) and np.all(window_end == shape)
+
+        # Extract body within window
+        window_slicer = tuple(slice(start, end) for start, end in zip(window_start, window_end))
+        window_body = lcat.masks.unpack(body_segmentation[window_slicer])
+
+        # Grow the window if it lies entirely within the body
+        if np.all(window_body) and not covers_scan:
+            padding *= 2
+            continue
+
+        # Calculate depths within the window
+        depths = scipy.ndimage.distance_transform_edt(window_body, sampling=spacing)
+
+        # Select nodule voxels
+        nodule_slicer = tuple(slice(start, end) for start, end
+                              in zip(nodule_start - window_start, nodule_end - window_start))
+        nodule_depths = depths[nodule_slicer][nodule.mask]
+
+        # Stop once no closer voxel outside of the body can lie outside the window
+        maximum_depth = np.max(nodule_depths) if nodule_depths.size else 0
+        if maximum_depth <= padding * np.min(spacing) or covers_scan:
+            break
+
+        # Otherwise grow the window to include every potentially closer voxel
+        padding = int(np.ceil(maximum_depth / np.min(spacing)))
+
+    return nodule_depths
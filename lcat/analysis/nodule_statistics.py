@@ -0,0 +1,112 @@
+"""
+Per-nodule statistics computed for all nodules of a scan at once.
+
+The voxels of all nodules are gathered into flat arrays of scan indices and nodule labels, and
+statistics are then reduced over the voxels of every nodule simultaneously. Each nodule contributes
+its own voxels, so nodules which overlap (as annotated by several readers) keep their own
+statistics, and the cost is linear in the total number of nodule voxels.
+"""
+from __future__ import division
+from collections import namedtuple
+
+import numpy as np
+
+import lcat.instrumentation
+import lcat.util
+
+
+# Version of the nodule statistics algorithm (increment when changing results)
+NODULE_STATISTICS_VERSION = 1
+
+# Nodule labels datatype
+# `indices` holds the flat scan index of each nodule voxel and `labels` the row of the nodule in
+# `scan.nodules` it belongs to (in the smallest sufficient unsigned integer type). Voxels are
+# ordered by nodule, and voxels shared by overlapping nodules appear once for each nodule.
+NoduleLabels = namedtuple('NoduleLabels', ['indices', 'labels'])
+
+# Nodule statistics datatype
+# Each field is an array with one entry per nodule (in the order of `scan.nodules`). `counts` holds
+# the number of voxels of each nodule within the scan, `centroids` the (N, 3) centroids of each
+# nodule and `covariances` the (N, 3, 3) second-order central moments of each nodule (normalized by
+# the voxel count), both in scan index coordinates. Statistics of nodules without voxels in the
+# scan are NaN.
+NoduleStatistics = namedtuple('NoduleStatistics', ['counts', 'centroids', 'covariances',
+                                                   'min_intensities', 'mean_intensities',
+                                                   'max_intensities'])
+
+
+@lcat.instrumentation.instrumented()
+def get_nodule_labels(scan):
+    """
+    Gather the voxels of the nodules of `scan` (clipped to the scan) into `NoduleLabels`.
+    """
+    # Label type placeholder
+    label_type = np.min_scalar_type(max(len(scan.nodules) - 1, 0))
+
+    # Index and label placeholders
+    indices = [np.zeros(0, dtype=np.intp)]
+    labels = [np.zeros(0, dtype=label_type)]
+
+    # For each nodule
+    for row, nodule in enumerate(scan.nodules):
+        # Find the nodule voxels within the scan
+        view = lcat.util.get_nodule_view(nodule, scan.voxels)
+        coordinates = np.nonzero(view.mask)
+
+        # Convert to flat scan indices
+        indices.append(np.ravel_multi_index([coordinate + start for coordinate, start
+                                             in zip(coordinates, view.origin)],
+                                            scan.voxels.shape))
+        labels.append(np.full(len(coordinates[0]), row, dtype=label_type))
+
+    return NoduleLabels(np.concatenate(indices), np.concatenate(labels))
+
+
+@lcat.instrumentation.instrumented()
+def get_nodule_statistics(scan, nodule_labels=None):
+    """
+    Compute the voxel counts, spatial moments and intensity statistics of all nodules of `scan` in a
+    single pass over the nodule voxels, using the given `NoduleLabels` (computed using
+    `get_nodule_labels` if not given). Returns a `NoduleStatistics`.
+    """
+    # Provide default labels
+    if nodule_labels is None:
+        nodule_labels = get_nodule_labels(scan)
+
+    # Gather nodule voxels
+    nodule_count = len(scan.nodules)
+    labels = nodule_labels.labels
+    coordinates = np.unravel_index(nodule_labels.indices, scan.voxels.shape)
+    intensities = scan.voxels[coordinates].astype(np.float64)
+
+    # Accumulate sums
+    counts = np.bincount(labels, minlength=nodule_count).astype(np.float64)
+    intensity_sums = np.bincount(labels, weights=intensities, minlength=nodule_count)
+    coordinate_sums = np.zeros((nodule_count, scan.voxels.ndim))
+    product_sums = np.zeros((nodule_count, scan.voxels.ndim, scan.voxels.ndim))
+    for axis, coordinate in enumerate(coordinates):
+        coordinate_sums[:, axis] = np.bincount(labels, weights=coordinate, minlength=nodule_count)
+        for other_axis, other_coordinate in enumerate(coordinates[:axis + 1]):
+            product_sum = np.bincount(labels, weights=coordinate * other_coordinate,
+                                      minlength=nodule_count)
+            product_sums[:, axis, other_axis] = product_sum
+            product_sums[:, other_axis, axis] = product_sum
+
+    # Reduce extrema over the runs of voxels of each nodule (voxels are ordered by nodule)
+    min_intensities = np.full(nodule_count, np.nan)
+    max_intensities = np.full(nodule_count, np.nan)
+    starts = np.flatnonzero(np.concatenate([[True], labels[1:] != labels[:-1]]))
+    if len(labels):
+        present = labels[starts]
+        min_intensities[present] = np.minimum.reduceat(intensities, starts)
+        max_intensities[present] = np.maximum.reduceat(intensities, starts)
+
+    # Normalize sums
+    with np.errstate(invalid='ignore', divide='ignore'):
+        centroids = coordinate_sums / counts[:, np.newaxis]
+        covariances = product_sums / counts[:, np.newaxis, np.newaxis] \
+            - centroids[:, :, np.newaxis] * centroids[:, np.newaxis, :]
+        mean_intensities = intensity_sums / counts
+
+    return NoduleStatistics(counts, centroids, covariances, min_intensities, mean_intensities,
+                            max_intensities)
@@ -3,16 +3,47 @@
 BMI 260: Final Project
 Bronchi segmentation/identification
 """
+from __future__ import division
+from collections import namedtuple
 import sys
 
 import numpy as np
+import scipy.ndimage
 
+import lcat
+import lcat.instrumentation
 
-def get_tracheal_distances(scan, lung_segmentation):
+
+# Version of the tracheal distance algorithm (increment when changing results)
+TRACHEAL_DISTANCE_VERSION = 1
+
+# Airway domain datatype (cropped to the reachable air region, `origin` is the crop offset)
+AirwayDomain = namedtuple('AirwayDomain', ['origin', 'domain', 'seed'])
+
+# Cropped distance map datatype (`origin` is the offset of `distances` in the full scan)
+DistanceMap = namedtuple('DistanceMap', ['origin', 'distances'])
+
+# Depth (in physical units) below the top of the lung air searched for the trachea
+TRACHEA_SEARCH_DEPTH = 10.0
+
+# Initial padding (in voxels) of the window searched for the airway voxels nearest to a nodule
+NEAREST_AIRWAY_INITIAL_PADDING = 8
+
+# Maximum in-plane distance of the trachea from the center of the lung air (relative to extent)
+TRACHEA_CENTER_TOLERANCE = 0.25
+
+
+@lcat.instrumentation.instrumented()
+def get_tracheal_distances(scan, lung_segmentation, crop=False):
     """
     Calculate a distance map for every accessible voxel in the lung segmentation of the distance
     from the top of the trachea to the voxel. Returns a masked numpy array representing the distance
-    assigned to each voxel.
+    (in physical units, taking the unit cell of the scan into account) assigned to each voxel.
+    `lung_segmentation` may be a dense array or a `lcat.masks.PackedMask`.
+
+    The fast marching problem is only solved within the bounding box of the air reachable from the
+    trachea. If `crop` is true, the result is returned as a `DistanceMap` containing only that
+    bounding box, rather than being expanded to the full size of the scan.
     """
     # Lazy-load skfmm
     try:
@@ -22,54 +53,246 @@ def get_tracheal_distances(scan, lung_segmentation):
               "`pip install scikit-fmm`.")
         sys.exit(1)
 
-    # Obtain median threshold
-    lung_threshold = np.median(scan.voxels[lung_segmentation])
+    # Identify the air reachable from the trachea
+    airway = get_airway_domain(scan, lung_segmentation)
 
-    # Select non-air elements
-    lung_tissue_mask = np.logical_and(lung_segmentation, scan.voxels > lung_threshold)
+    # Compute distances
+    spacing = np.asarray(scan.unit_cell, dtype=np.float64)
+    distances = march(skfmm, airway.domain, airway.seed, dx=spacing)
 
-    # Compute boundaries affecting lung air
-    air_boundaries = np.logical_or(lung_tissue_mask, np.logical_not(lung_segmentation))
+    # Return cropped distances if requested
+    distance_map = DistanceMap(airway.origin, distances)
+    if crop:
+        return distance_map
 
-    # Choose seed point
-    # TODO: Choose seed point better (actually find trachea, don't assume top)
-    seed_boundary = get_seed_boundary(lung_segmentation)
+    return expand_distance_map(distance_map, scan.voxels.shape)
 
-    # Set up fast marching problem
-    phi = np.ma.MaskedArray(seed_boundary, air_boundaries)
+
+def march(skfmm, domain, seed, dx=1):
+    """
+    Solve the fast marching problem over the binary array `domain`, starting from the voxels in
+    `seed`. `dx` is the voxel spacing (a scalar or one value per axis). Returns a float32 masked
+    array of distances, with voxels outside `domain` masked.
+    """
+    # Set up fast marching problem (zero at the seed)
+    phi = np.ones(domain.shape, dtype=np.float32)
+    phi[seed] = 0
+    phi = np.ma.MaskedArray(phi, np.logical_not(domain))
 
     # Perform fast marching problem
-    distances = skfmm.distance(phi)
+    return skfmm.distance(phi, dx=dx).astype(np.float32)
 
-    # TODO: Return something else?
-    return distances
 
+@lcat.instrumentation.instrumented()
+def get_nodule_tracheal_distances(scan, lung_segmentation):
+    """
+    Calculate the distance (in physical units) from the top of the trachea to every voxel of each
+    nodule in `scan`. Nodule voxels outside the airway are assigned the distance of the nearest
+    airway voxel. Distances are only computed within the bounding box of the air reachable from the
+    trachea, and are never expanded to the full size of the scan. Returns a list containing an
+    array of voxel distances for each nodule in `scan.nodules`.
+    """
+    # Lazy-load skfmm
+    try:
+        import skfmm
+    except ImportError:
+        print("Tracheal distance calculation requires scikit-fmm to be installed. Please execute "
+              "`pip install scikit-fmm`.")
+        sys.exit(1)
+
+    # Identify the air reachable from the trachea
+    airway = get_airway_domain(scan, lung_segmentation)
+
+    # Identify the nearest airway voxel for each nodule voxel
+    spacing = np.asarray(scan.unit_cell, dtype=np.float64)
+    targets = [get_nearest_airway_indices(lcat.util.get_nodule_view(nodule, scan.voxels), airway,
+                                          scan.voxels.shape, spacing)
+               for nodule in scan.nodules]
+
+    # Compute distances over the airway domain
+    distances = march(skfmm, airway.domain, airway.seed, dx=spacing)
+
+    return [np.ma.getdata(distances).ravel()[target] for target in targets]
 
-def get_seed_boundary(lung_segmentation):
+
+def get_nearest_airway_indices(nodule, airway, shape, spacing=None):
     """
-    Given a `lung_segmentation`, identify and return the top slice of the trachea.
+    Given a `nodule` (or a `lcat.util.NoduleView`) and an `AirwayDomain` in a scan of the given
+    `shape` and voxel `spacing` (defaulting to unit spacing), return the flat index into
+    `airway.domain` of the airway voxel physically nearest to each voxel of the nodule mask. The
+    search is performed in a window around the nodule, which grows until it is guaranteed to
+    contain the nearest airway voxel. Nodules without any voxels yield an empty array.
     """
-    # Trachea disc placeholder
-    trachea_index = None
+    # Provide default spacing
+    if spacing is None:
+        spacing = np.ones(len(shape))
+    spacing = np.asarray(spacing, dtype=np.float64)
+
+    # Determine nodule extents
+    nodule_start = np.asarray(nodule.origin)
+    nodule_end = nodule_start + nodule.mask.shape
+
+    # Grow window until the nearest airway voxels are found
+    padding = NEAREST_AIRWAY_INITIAL_PADDING
+    while True:
+        # Determine window (clipped to the scan)
+        window_start = np.maximum(nodule_start - padding, 0)
+        window_end = np.minimum(nodule_end + padding, shape)
+        covers_scan = np.all(window_start == 0) and np.all(window_end == shape)
+
+        # Extract airway within window
+        window_airway = lcat.util.get_window(airway.domain, airway.origin, window_start,
+                                             window_end)
 
-    # For each slice
-    for z_index in range(lung_segmentation.shape[2]):
-        # Set candidate trachea disc
-        candidate_trachea_disc = lung_segmentation[..., z_index]
+        # Grow the window if it doesn't contain any airway
+        if not np.any(window_airway):
+            if covers_scan:
+                raise Exception("No airway found in scan")
+            padding *= 2
+            continue
 
-        # Check for content
-        if np.sum(candidate_trachea_disc) > 0:
-            trachea_index = z_index
+        # Find the nearest airway voxel within the window
+        # See https://stackoverflow.com/questions/3662361/
+        distances, indices = scipy.ndimage.distance_transform_edt(np.logical_not(window_airway),
+                                                                  sampling=spacing,
+                                                                  return_indices=True)
+
+        # Select nodule voxels
+        nodule_slicer = tuple(slice(start, end) for start, end
+                              in zip(nodule_start - window_start, nodule_end - window_start))
+        nodule_distances = distances[nodule_slicer][nodule.mask]
+
+        # Stop once no closer airway voxel can lie outside the window
+        maximum_distance = np.max(nodule_distances) if nodule_distances.size else 0
+        if maximum_distance <= padding * np.min(spacing) or covers_scan:
             break
 
-    # Make sure there was a slice with content
-    if trachea_index is None:
+        # Otherwise grow the window to include every potentially closer voxel
+        padding = int(np.ceil(maximum_distance / np.min(spacing)))
+
+    # Convert nearest coordinates to flat airway domain indices
+    coordinates = [axis_indices[nodule_slicer][nodule.mask] + start - airway_start
+                   for axis_indices, start, airway_start
+                   in zip(indices, window_start, airway.origin)]
+
+    return np.ravel_multi_index(coordinates, airway.domain.shape)
+
+
+def expand_distance_map(distance_map, shape):
+    """
+    Given a cropped `DistanceMap`, return a masked array of the given `shape` with the distances
+    placed at their original location and all other voxels masked.
+    """
+    # Create fully masked placeholder
+    distances = np.ma.MaskedArray(np.zeros(shape, dtype=distance_map.distances.dtype),
+                                  np.ones(shape, dtype=bool))
+
+    # Fill cropped region
+    slicer = tuple(slice(start, start + dim)
+                   for start, dim in zip(distance_map.origin, distance_map.distances.shape))
+    distances[slicer] = distance_map.distances
+
+    return distances
+
+
+def get_air_mask(voxels, lung_segmentation):
+    """
+    Given `voxels` and a matching dense `lung_segmentation`, return a mask of the air within the
+    lungs (the voxels which are no denser than the median lung voxel).
+    """
+    # Obtain median threshold
+    lung_threshold = np.median(voxels[lung_segmentation])
+
+    # Select air elements
+    return np.logical_and(lung_segmentation, voxels <= lung_threshold)
+
+
+def get_airway_domain(scan, lung_segmentation):
+    """
+    Identify the trachea and the air within the lungs that is reachable from it. Returns an
+    `AirwayDomain` containing the reachable air and the top slice of the trachea, both cropped to
+    the bounding box of the reachable air (padded by one voxel where possible). `lung_segmentation`
+    may be a dense array or a `lcat.masks.PackedMask`.
+    """
+    # Make sure there's content (dense arrays and packed masks both support `any`)
+    if not lung_segmentation.any():
         raise Exception("No content in lung segmentation")
 
-    # Create same-size array of ones
-    trachea_ceiling = np.ones(lung_segmentation.shape)
+    # Crop to the lungs
+    lung_box = lcat.util.get_bounding_box(lung_segmentation)
+    lung_segmentation = lcat.masks.unpack(lcat.util.crop_to_box(lung_segmentation, lung_box))
+    voxels = lcat.util.crop_to_box(scan.voxels, lung_box)
+
+    # Identify lung air
+    air_mask = get_air_mask(voxels, lung_segmentation)
+    del lung_segmentation
+
+    # Find the top of the trachea
+    seed = find_trachea(air_mask, scan.unit_cell)
+
+    # Flood fill the air reachable from the trachea
+    reachable = scipy.ndimage.binary_propagation(seed, mask=air_mask)
+    del air_mask
+
+    # Crop to reachable air (with one voxel of padding where available)
+    reachable_box = [(max(start - 1, 0), min(end + 1, dim - 1))
+                     for (start, end), dim in zip(lcat.util.get_bounding_box(reachable),
+                                                  reachable.shape)]
+    domain = lcat.util.crop_to_box(reachable, reachable_box).copy()
+    seed = lcat.util.crop_to_box(seed, reachable_box).copy()
+
+    # Compute origin in scan coordinates
+    origin = [int(lung_start + start)
+              for (lung_start, lung_end), (start, end) in zip(lung_box, reachable_box)]
+
+    return AirwayDomain(origin, domain, seed)
+
+
+def find_trachea(air_mask, unit_cell=None):
+    """
+    Given a mask of the air within the lungs (with the given `unit_cell`, defaulting to unit
+    spacing), identify the top slice of the trachea. The trachea is taken to be the largest air
+    component near the in-plane center of the top slices of the lungs. Returns a mask of the same
+    shape as `air_mask` marking the top slice of the trachea.
+    """
+    # Provide default unit cell
+    if unit_cell is None:
+        unit_cell = np.ones(air_mask.ndim)
+
+    # Find the topmost slice containing air
+    occupied = np.flatnonzero(np.any(air_mask, axis=(0, 1)))
+    if len(occupied) == 0:
+        raise Exception("No content in lung segmentation")
+    top_index = occupied[0]
+
+    # Label air components in the top slab
+    search_slices = max(int(np.ceil(TRACHEA_SEARCH_DEPTH / unit_cell[-1])), 1)
+    slab = air_mask[..., top_index:top_index + search_slices]
+    labels, label_count = scipy.ndimage.label(slab)
+    component_indices = np.arange(1, label_count + 1)
+
+    # Measure each component
+    sizes = scipy.ndimage.sum(slab, labels, component_indices)
+    centers = np.asarray(scipy.ndimage.center_of_mass(slab, labels, component_indices))
+
+    # Determine in-plane offsets from the center of the lung air (relative to extent)
+    extent = np.asarray(air_mask.shape[:2], dtype=float)
+    offsets = np.abs(centers[:, :2] - (extent - 1) / 2) / extent
+
+    # Prefer central components, choosing the largest
+    central = np.all(offsets <= TRACHEA_CENTER_TOLERANCE, axis=1)
+    if np.any(central):
+        candidates = component_indices[central]
+        trachea_label = candidates[np.argmax(sizes[central])]
+    else:
+        trachea_label = component_indices[np.argmin(np.max(offsets, axis=1))]
+
+    # Identify the top slice of the trachea
+    trachea = labels == trachea_label
+    trachea_top = np.flatnonzero(np.any(trachea, axis=(0, 1)))[0]
 
-    # Set top of trachea as starting point
-    trachea_ceiling[lung_segmentation[..., trachea_index]] = 0
+    # Mark the top slice of the trachea in the full mask
+    seed = np.zeros(air_mask.shape, dtype=bool)
+    seed[..., top_index + trachea_top] = trachea[..., trachea_top]
 
-    return trachea_ceiling
+    return seed
@@ -0,0 +1,218 @@
+"""
+Persistent on-disk caching for the lcat toolkit.
+
+Cached entries are stored below a cache folder, which is either passed explicitly or taken from
+the `LCAT_CACHE_FOLDER` environment variable. Entries are written atomically, so a single cache
+folder can be shared by several worker processes on the same node.
+"""
+from __future__ import absolute_import
+import functools
+import hashlib
+import os
+import tempfile
+import weakref
+
+import numpy as np
+
+import lcat.masks
+
+
+# Environment variable specifying the default cache folder
+CACHE_FOLDER_VARIABLE = 'LCAT_CACHE_FOLDER'
+
+# Voxel fingerprint placeholder (keyed by array id)
+VOXEL_FINGERPRINTS = {}
+
+
+def get_cache_folder(cache_folder=None):
+    """
+    Return the cache folder to use, falling back to the `LCAT_CACHE_FOLDER` environment variable.
+    Returns None if caching is disabled.
+    """
+    if cache_folder is not None:
+        return cache_folder
+
+    return os.environ.get(CACHE_FOLDER_VARIABLE) or None
+
+
+def get_cache_path(cache_folder, category, key, extension='.npz'):
+    """
+    Return the path of the cache entry `key` in `category` below `cache_folder`.
+    """
+    return os.path.join(cache_folder, category, key + extension)
+
+
+def get_key(*parts):
+    """
+    Combine the given parts (which must have a stable `repr`) into a single cache key.
+    """
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+
+def get_voxel_fingerprint(voxels):
+    """
+    Return a fingerprint of the contents of the array `voxels`. Fingerprints are remembered for the
+    lifetime of the array, so the array must not be modified in place after fingerprinting.
+    """
+    # Check for a remembered fingerprint
+    entry = VOXEL_FINGERPRINTS.get(id(voxels))
+    if entry is not None and entry[0]() is voxels:
+        return entry[1]
+
+    # Hash the shape, type and contents slice by slice to avoid a full contiguous copy
+    hasher = hashlib.sha1()
+    hasher.update(repr((voxels.shape, voxels.dtype.str)).encode('utf-8'))
+    for z_index in range(voxels.shape[-1]):
+        hasher.update(np.ascontiguousarray(voxels[..., z_index]).data)
+    fingerprint = hasher.hexdigest()
+
+    # Remember fingerprint until the array is garbage collected
+    key = id(voxels)
+    reference = weakref.ref(voxels, lambda _: VOXEL_FINGERPRINTS.pop(key, None))
+    VOXEL_FINGERPRINTS[key] = (reference, fingerprint)
+
+    return fingerprint
+
+
+def get_scan_fingerprint(scan):
+    """
+    Return a fingerprint of the voxels of `scan`, taking into account the voxel contents and the
+    resampling parameters of the scan.
+    """
+    # Describe resampling
+    resampling = (tuple(scan.voxels.shape), tuple(float(step) for step in scan.unit_cell))
+
+    return get_key(get_voxel_fingerprint(scan.voxels), resampling)
+
+
+def get_scan_key(scan, name, version):
+    """
+    Return a cache key for the result `name` at algorithm `version` computed from the voxels of
+    `scan` (see `get_scan_fingerprint`).
+    """
+    return get_key(name, version, get_scan_fingerprint(scan))
+
+
+def get_mask_fingerprint(mask):
+    """
+    Return a fingerprint of the contents of the binary `mask` (a dense array or a
+    `lcat.masks.PackedMask`).
+    """
+    mask = lcat.masks.pack(mask)
+
+    return get_key(tuple(mask.shape), get_voxel_fingerprint(mask.bits))
+
+
+def get_annotation_fingerprint(nodules):
+    """
+    Return a fingerprint of the nodule annotations `nodules` (IDs, characteristics, placement and
+    masks).
+    """
+    hasher = hashlib.sha1()
+    for nodule in nodules:
+        # Hash the nodule description
+        description = (nodule.nodule_id, sorted(nodule.characteristics.items()),
+                       tuple(int(start) for start in nodule.origin), tuple(nodule.mask.shape))
+        hasher.update(repr(description).encode('utf-8'))
+
+        # Hash the mask contents
+        hasher.update(np.packbits(np.asarray(nodule.mask, dtype=bool)).tobytes())
+
+    return hasher.hexdigest()
+
+
+def save_arrays(path, **arrays):
+    """
+    Atomically write the given arrays to a compressed `.npz` file at `path`.
+    """
+    # Make sure the destination folder exists
+    folder = os.path.dirname(path)
+    try:
+        os.makedirs(folder)
+    except OSError:
+        if not os.path.isdir(folder):
+            raise
+
+    # Write to a temporary file in the same folder
+    handle, temporary_path = tempfile.mkstemp(dir=folder, suffix='.tmp')
+    try:
+        with os.fdopen(handle, 'wb') as temporary_file:
+            np.savez_compressed(temporary_file, **arrays)
+
+        # Move into place
+        replace = getattr(os, 'replace', os.rename)
+        replace(temporary_path, path)
+    except:
+        os.remove(temporary_path)
+        raise
+
+
+def load_arrays(path):
+    """
+    Load the arrays stored at `path` into a dictionary. Returns None if no readable entry exists.
+    """
+    try:
+        with np.load(path) as entry:
+            return dict((name, entry[name]) for name in entry.files)
+    except (IOError, OSError, ValueError, KeyError):
+        return None
+
+
+def save_mask(path, mask):
+    """
+    Store the binary `mask` at `path` in bit-packed, compressed form.
+    """
+    mask = lcat.masks.pack(mask)
+    save_arrays(path, bits=mask.bits, shape=np.asarray(mask.shape))
+
+
+def load_mask(path):
+    """
+    Load a `lcat.masks.PackedMask` stored using `save_mask`. Returns None if no readable entry
+    exists.
+    """
+    arrays = load_arrays(path)
+    if arrays is None:
+        return None
+
+    return lcat.masks.PackedMask(arrays['bits'], arrays['shape'])
+
+
+def cached_mask(mask_name, version):
+    """
+    Function decorator which persists the binary mask computed from a scan by the decorated
+    function. The decorated function must accept a scan and a `packed` keyword argument. The
+    wrapped function additionally accepts a `cache_folder` keyword argument (see
+    `get_cache_folder`). Cache entries are keyed by the voxel contents, the resampling parameters
+    of the scan, `mask_name` and `version`, so `version` must be incremented whenever the algorithm
+    changes.
+    """
+    def decorator(compute_mask):
+        """
+        Wrap `compute_mask` with a persistent cache.
+        """
+        @functools.wraps(compute_mask)
+        def wrapper(scan, packed=False, cache_folder=None):
+            # Skip caching if no cache folder is configured
+            cache_folder = get_cache_folder(cache_folder)
+            if cache_folder is None:
+                return compute_mask(scan, packed=packed)
+
+            # Look for an existing entry
+            key = get_scan_key(scan, mask_name, version)
+            path = get_cache_path(cache_folder, mask_name, key)
+            mask = load_mask(path)
+
+            # Compute and store the mask if necessary
+            if mask is None:
+                mask = compute_mask(scan, packed=True)
+                save_mask(path, mask)
+
+            if packed:
+                return mask
+
+            return mask.to_dense()
+
+        return wrapper
+
+    return decorator
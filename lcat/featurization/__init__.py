@@ -10,7 +10,9 @@ from . import registry
 from . import body_depth
 from . import center
 from . import characteristics
+from . import products
 from . import region_properties
+from . import shape
 from . import tracheal_distance
 
 # Import registry featurization functions
@@ -4,48 +4,36 @@ Body depth featurization module.
 from __future__ import absolute_import
 
 import numpy as np
-import pandas as pd
-import scipy.ndimage
 
 import lcat
 from . import registry
 
 
-@registry.register_featurizer('body_depth')
-def featurize_center(scan):
+@registry.register_featurizer('body_depth', requires=['body_segmentation'], version=2)
+def featurize_center(scan, body_segmentation):
     """
     Featurize the given scan, returning body depth statistics.
     """
     # Create data distance placeholder
-    index = pd.Index([], name='nodule_id')
-    data = pd.DataFrame(index=index, columns=['min_body_depth',
-                                              'mean_body_depth',
-                                              'median_body_depth',
-                                              'max_body_depth'])
+    data = registry.ResultBuilder(scan, ['min_body_depth',
+                                         'mean_body_depth',
+                                         'median_body_depth',
+                                         'max_body_depth'])
 
-    # Get the body segmentation for the scan
-    body_shell = lcat.get_body_segmentation(scan)
+    # Calculate body depths around each nodule
+    all_nodule_depths = lcat.analysis.get_nodule_body_depths(scan, body_segmentation)
 
-    # Get body depths
-    body_depths = scipy.ndimage.distance_transform_edt(body_shell)
-
-    # Multiply by unit lengths (assume cubic unit cell)
-    body_depths *= np.mean(scan.unit_cell[0])
-
-    # For each nodule
-    for nodule in scan.nodules:
-        # Create full mask
-        mask = lcat.util.get_full_nodule_mask(nodule, scan.voxels.shape)
-
-        # Select tumor tracheal distances
-        nodule_depths = body_depths[mask]
+    # For each nodule with voxels in the scan
+    for row, nodule_depths in enumerate(all_nodule_depths):
+        if nodule_depths.size == 0:
+            continue
 
         # Add attributes to dataframe
-        data.loc[nodule.nodule_id, :] = [
+        data[row] = [
             np.min(nodule_depths),
             np.mean(nodule_depths),
             np.median(nodule_depths),
             np.max(nodule_depths)
         ]
 
-    return data
+    return data.to_frame()
@@ -3,34 +3,20 @@ X, Y and Z featurization module.
 """
 from __future__ import absolute_import
 
-import pandas as pd
-import scipy.ndimage
+import numpy as np
 
-import lcat
 from . import registry
 
 
-@registry.register_featurizer('center')
-def featurize_center(scan):
+@registry.register_featurizer('center', requires=['nodule_statistics'])
+def featurize_center(scan, nodule_statistics):
     """
-    Featurize the given scan, returning tracheal distance statistics.
+    Featurize the given scan, returning the center of mass of each nodule (in real space).
     """
     # Create data distance placeholder
-    index = pd.Index([], name='nodule_id')
-    data = pd.DataFrame(index=index, columns=['center_x', 'center_y', 'center_z'])
+    data = registry.ResultBuilder(scan, ['center_x', 'center_y', 'center_z'])
 
-    # For each nodule
-    for nodule in scan.nodules:
-        # Create full mask
-        mask = lcat.util.get_full_nodule_mask(nodule, scan.voxels.shape)
+    # Convert centers of mass (in scan coordinates) to real space
+    data[:] = nodule_statistics.centroids * np.asarray(scan.unit_cell, dtype=np.float64)
 
-        # Calculate center of mass
-        center = scipy.ndimage.measurements.center_of_mass(mask)
-
-        # Convert to real space
-        real_center = [coordinate * unit for coordinate, unit in zip(center, scan.unit_cell)]
-
-        # Add attributes to dataframe
-        data.loc[nodule.nodule_id] = real_center
-
-    return data
+    return data.to_frame()
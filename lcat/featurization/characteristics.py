@@ -4,7 +4,6 @@ Characteristics featurization module.
 from __future__ import absolute_import
 
 import numpy as np
-import pandas as pd
 import scipy.ndimage
 
 import lcat
@@ -24,19 +23,18 @@ CHARACTERISTICS = [
 ]
 
 
-@registry.register_featurizer('characteristics')
+@registry.register_featurizer('characteristics', inputs=('nodules',))
 def featurize_characteristics(scan):
     """
     Featurize the given scan, returning nodule characteristics.
     """
     # Create data distance placeholder
-    index = pd.Index([], name='nodule_id')
-    data = pd.DataFrame(index=index, columns=CHARACTERISTICS)
+    data = registry.ResultBuilder(scan, CHARACTERISTICS)
 
     # For each nodule
-    for nodule in scan.nodules:
+    for row, nodule in enumerate(scan.nodules):
         # Load characteristics
-        data.loc[nodule.nodule_id] = [nodule.characteristics.get(attribute, np.nan)
-                                      for attribute in CHARACTERISTICS]
+        data[row] = [nodule.characteristics.get(attribute, np.nan)
+                     for attribute in CHARACTERISTICS]
 
-    return data
+    return data.to_frame()
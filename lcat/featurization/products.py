@@ -0,0 +1,69 @@
+"""
+Intermediate products shared between featurizers.
+"""
+from __future__ import absolute_import
+
+import lcat
+import lcat.analysis.nodule_statistics
+import lcat.analysis.tracheal_distance
+import lcat.segmentation.body
+import lcat.segmentation.lungs
+from . import registry
+
+
+@registry.register_product('lung_segmentation',
+                           version=lcat.segmentation.lungs.SEGMENTATION_VERSION, cached=True)
+def produce_lung_segmentation(scan, cache_folder=None):
+    """
+    Produce the lung segmentation of the given scan (as a `lcat.masks.PackedMask`).
+    """
+    return lcat.get_lung_segmentation(scan, packed=True, cache_folder=cache_folder)
+
+
+@registry.register_product('body_segmentation',
+                           version=lcat.segmentation.body.SEGMENTATION_VERSION, cached=True)
+def produce_body_segmentation(scan, cache_folder=None):
+    """
+    Produce the body segmentation of the given scan (as a `lcat.masks.PackedMask`).
+    """
+    return lcat.get_body_segmentation(scan, packed=True, cache_folder=cache_folder)
+
+
+@registry.register_product('tracheal_distance_map', requires=['lung_segmentation'],
+                           version=lcat.analysis.tracheal_distance.TRACHEAL_DISTANCE_VERSION)
+def produce_tracheal_distance_map(scan, lung_segmentation):
+    """
+    Produce a map of the distance from the top of the trachea to each voxel of the airway (as a
+    cropped `lcat.analysis.tracheal_distance.DistanceMap`).
+    """
+    return lcat.get_tracheal_distances(scan, lung_segmentation, crop=True)
+
+
+@registry.register_product('nodule_tracheal_distances', requires=['lung_segmentation'],
+                           version=lcat.analysis.tracheal_distance.TRACHEAL_DISTANCE_VERSION)
+def produce_nodule_tracheal_distances(scan, lung_segmentation):
+    """
+    Produce the distance from the top of the trachea to each voxel of each nodule of the given scan
+    (as a list with an array of voxel distances per nodule).
+    """
+    return lcat.get_nodule_tracheal_distances(scan, lung_segmentation)
+
+
+@registry.register_product('nodule_labels',
+                           version=lcat.analysis.nodule_statistics.NODULE_STATISTICS_VERSION)
+def produce_nodule_labels(scan):
+    """
+    Produce the flat scan indices and labels of the voxels of all nodules of the given scan (as a
+    `lcat.analysis.nodule_statistics.NoduleLabels`).
+    """
+    return lcat.analysis.get_nodule_labels(scan)
+
+
+@registry.register_product('nodule_statistics', requires=['nodule_labels'],
+                           version=lcat.analysis.nodule_statistics.NODULE_STATISTICS_VERSION)
+def produce_nodule_statistics(scan, nodule_labels):
+    """
+    Produce the voxel counts, centroids and intensity statistics of all nodules of the given scan
+    (as a `lcat.analysis.nodule_statistics.NoduleStatistics`).
+    """
+    return lcat.analysis.get_nodule_statistics(scan, nodule_labels)
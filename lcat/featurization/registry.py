@@ -3,27 +3,77 @@ Feature registry module of Lung Cancer Action Team package.
 """
 from __future__ import print_function
 import itertools
+import multiprocessing
+import multiprocessing.pool
+import os
+import threading
 
+import numpy as np
 import pandas as pd
 
+import lcat.cache
+import lcat.instrumentation
+import lcat.shared
+
 
 # Featurizer placeholder
 FEATURIZERS = {}
 
+# Featurizer requirements placeholder (names of the products required by each featurizer)
+FEATURIZER_REQUIREMENTS = {}
+
+# Featurizer version placeholder
+FEATURIZER_VERSIONS = {}
+
+# Featurizer inputs placeholder (parts of the scan each featurizer depends on)
+FEATURIZER_INPUTS = {}
+
+# Scan parts which featurizers may depend on: the voxels (including their resampling) and the
+# nodule annotations
+SCAN_INPUTS = ('voxels', 'nodules')
+
+# Product placeholder
+PRODUCERS = {}
+
+# Product requirements placeholder (names of the products required by each product)
+PRODUCT_REQUIREMENTS = {}
+
+# Product version placeholder
+PRODUCT_VERSIONS = {}
+
+# Names of the products whose producers persist their results (and accept a cache folder)
+CACHED_PRODUCTS = set()
 
-def register_featurizer(featurizer_name):
+
+def register_featurizer(featurizer_name, requires=(), version=1, inputs=SCAN_INPUTS):
     """
     Function decorator which registers the given function under the argument `featurizer_name` as
     a featurizer. The function must accept a single scan and return a pandas DataFrame containing
     columns representing features and rows representing nodules. The Index must specify the
-    nodule_id for each nodule.
+    nodule_id for each nodule. Such DataFrames are most easily built using `ResultBuilder`.
+
+    `requires` lists the names of the intermediate products (see `register_product`) used by the
+    featurizer, which are passed to the function as keyword arguments of the same name.
+
+    Featurizer results are cached (see `featurize_scan`) by `version` (which must be incremented
+    whenever the results of the featurizer change), by the versions of the products it requires
+    (directly or indirectly) and by the parts of the scan listed in `inputs` (a subset of
+    `SCAN_INPUTS`). Featurizers which don't use the voxels should declare `inputs=('nodules',)`.
     """
+    # Make sure inputs are known
+    for input_name in inputs:
+        if input_name not in SCAN_INPUTS:
+            raise KeyError("Unknown featurizer input '%s'." % input_name)
+
     def decorator(featurize):
         """
         Register the function `featurize` as a featurizer
         """
         # Store the function
         FEATURIZERS[featurizer_name] = featurize
+        FEATURIZER_REQUIREMENTS[featurizer_name] = tuple(requires)
+        FEATURIZER_VERSIONS[featurizer_name] = version
+        FEATURIZER_INPUTS[featurizer_name] = tuple(inputs)
 
         # Return it unchanged
         return featurize
@@ -32,36 +82,439 @@ def register_featurizer(featurizer_name):
     return decorator
 
 
-def featurize_scan(scan):
+def register_product(product_name, requires=(), version=1, cached=False):
     """
-    Featurize the given scan, using all available featurizers. Returns a pandas DataFrame with all
-    featurizer results, indexed by patient_id and nodule_id using a MultiIndex.
+    Function decorator which registers the given function under the argument `product_name` as the
+    producer of an intermediate product shared between featurizers (such as a segmentation or a
+    distance map). The function must accept a single scan and return the product. `requires` lists
+    the names of other products used to compute this one, which are passed to the function as
+    keyword arguments of the same name. `version` must change whenever the product changes (usually
+    by passing the version of the underlying algorithm), invalidating the cached results of the
+    featurizers requiring it. If `cached` is true, the function must also accept a `cache_folder`
+    keyword argument, which receives the cache folder of the featurization (see `featurize_scan`).
+    """
+    def decorator(produce):
+        """
+        Register the function `produce` as a producer
+        """
+        # Store the function
+        PRODUCERS[product_name] = produce
+        PRODUCT_REQUIREMENTS[product_name] = tuple(requires)
+        PRODUCT_VERSIONS[product_name] = version
+        if cached:
+            CACHED_PRODUCTS.add(product_name)
+
+        # Return it unchanged
+        return produce
+
+    return decorator
+
+
+class ProductStore(object):
+    """
+    Holds the intermediate products of a single scan for a set of featurizers. Each product is
+    computed on first use, at most once, and is freed as soon as no pending featurizer or product
+    requires it. Products may be requested concurrently from several threads. Cached products (see
+    `register_product`) are persisted to `cache_folder` (see `lcat.cache.get_cache_folder`).
+    """
+    def __init__(self, scan, featurizer_names, cache_folder=None):
+        self.scan = scan
+        self.cache_folder = cache_folder
+        self.products = {}
+        self.pending = {}
+
+        # Tag instrumentation records of the scan (also from other threads) with the current tags
+        self.tags = {'patient_id': scan.patient_id}
+        self.tags.update(lcat.instrumentation.get_tags())
+
+        # Count the pending consumers of each (transitively) required product
+        for featurizer_name in featurizer_names:
+            for product_name in FEATURIZER_REQUIREMENTS[featurizer_name]:
+                self.add_consumer(product_name)
+
+        # Create locks guarding the computation of each product and the consumer counts
+        self.product_locks = dict((product_name, threading.Lock()) for product_name in self.pending)
+        self.pending_lock = threading.Lock()
+
+    def add_consumer(self, product_name):
+        """
+        Record an additional pending consumer of the product `product_name`.
+        """
+        # Make sure the product exists
+        if product_name not in PRODUCERS:
+            raise KeyError("No producer is registered for product '%s'." % product_name)
+
+        # The first consumer also makes the product's own requirements pending
+        if product_name not in self.pending:
+            self.pending[product_name] = 0
+            for requirement in PRODUCT_REQUIREMENTS[product_name]:
+                self.add_consumer(requirement)
+
+        self.pending[product_name] += 1
+
+    def get(self, product_name):
+        """
+        Return the product `product_name`, computing it if necessary.
+        """
+        with self.product_locks[product_name]:
+            if product_name not in self.products:
+                # Compute the product from its requirements
+                requirements = PRODUCT_REQUIREMENTS[product_name]
+                try:
+                    arguments = dict((requirement, self.get(requirement))
+                                     for requirement in requirements)
+                    if product_name in CACHED_PRODUCTS:
+                        arguments['cache_folder'] = self.cache_folder
+                    with lcat.instrumentation.tagged(**self.tags), \
+                            lcat.instrumentation.stage('product:' + product_name):
+                        product = PRODUCERS[product_name](self.scan, **arguments)
+                    del arguments
+                finally:
+                    self.release(requirements)
+
+                # Store the product
+                self.products[product_name] = product
+
+            return self.products[product_name]
+
+    def release(self, product_names):
+        """
+        Record that a consumer of each of the products in `product_names` has finished, freeing any
+        products which are no longer required.
+        """
+        with self.pending_lock:
+            for product_name in product_names:
+                self.pending[product_name] -= 1
+                if self.pending[product_name] <= 0:
+                    self.products.pop(product_name, None)
+
+
+def get_featurizer_names(featurizer_names=None):
     """
-    # Featurizations placeholder
-    featurizations = []
+    Return the list of featurizer names to run, defaulting to all registered featurizers (in
+    alphabetical order).
+    """
+    if featurizer_names is None:
+        return sorted(FEATURIZERS)
+
+    # Make sure all featurizers exist
+    for featurizer_name in featurizer_names:
+        if featurizer_name not in FEATURIZERS:
+            raise KeyError("No featurizer is registered as '%s'." % featurizer_name)
+
+    return list(featurizer_names)
+
+
+def get_featurizer_groups(featurizer_names):
+    """
+    Partition `featurizer_names` into groups of featurizers which (transitively) share intermediate
+    products, so that each group can be run independently without computing a product twice.
+    Returns a list of lists of featurizer names, preserving the order of `featurizer_names`.
+    """
+    # Groups placeholder (pairs of product name sets and featurizer names)
+    groups = []
 
     # For each featurizer
-    for featurizer_name, featurizer in FEATURIZERS.iteritems():
-        # Featurize the scan
-        try:
-            featurizations.append(featurizer(scan))
-        except:
-            print("Error featurizing scan for patient '%s' using featurizer '%s', skipping..."
-                  % (scan.patient_id, featurizer_name))
+    for featurizer_name in featurizer_names:
+        # Collect all (transitively) required products
+        products = set()
+        queue = list(FEATURIZER_REQUIREMENTS[featurizer_name])
+        while queue:
+            product_name = queue.pop()
+            if product_name not in products:
+                products.add(product_name)
+                queue.extend(PRODUCT_REQUIREMENTS[product_name])
+
+        # Merge with all groups sharing a product
+        merged_names = []
+        remaining_groups = []
+        for group_products, group_names in groups:
+            if group_products & products:
+                products |= group_products
+                merged_names.extend(group_names)
+            else:
+                remaining_groups.append((group_products, group_names))
+        groups = remaining_groups + [(products, merged_names + [featurizer_name])]
+
+    # Order featurizers within groups consistently
+    order = dict((featurizer_name, index) for index, featurizer_name in enumerate(featurizer_names))
+    return [sorted(group_names, key=order.get) for _, group_names in groups]
+
+
+def run_featurizer(featurizer_name, store):
+    """
+    Run the featurizer `featurizer_name` on the scan of the `ProductStore` `store`, providing its
+    required products.
+    """
+    requirements = FEATURIZER_REQUIREMENTS[featurizer_name]
+    try:
+        arguments = dict((requirement, store.get(requirement)) for requirement in requirements)
+        with lcat.instrumentation.tagged(**store.tags), \
+                lcat.instrumentation.stage('featurizer:' + featurizer_name):
+            return FEATURIZERS[featurizer_name](store.scan, **arguments)
+    finally:
+        store.release(requirements)
+
+
+class ResultBuilder(object):
+    """
+    Collects the feature values computed by a featurizer for each nodule of a scan into a
+    preallocated float64 array, with one row per nodule (in the order of `scan.nodules`) and one
+    column per feature. Rows are assigned using `builder[row] = values`, and rows which are never
+    assigned are left as NaN. Use `to_frame` to obtain the featurizer result.
+    """
+    def __init__(self, scan, columns):
+        self.columns = list(columns)
+        self.nodule_ids = [nodule.nodule_id for nodule in scan.nodules]
+        self.values = np.full((len(self.nodule_ids), len(self.columns)), np.nan)
+
+    def __setitem__(self, row, values):
+        self.values[row] = values
+
+    def to_frame(self):
+        """
+        Return the collected values as a float64 pandas DataFrame indexed by nodule_id. If several
+        nodules share a nodule_id, the values of the last of them are kept.
+        """
+        # Create dataframe
+        index = pd.Index(self.nodule_ids, name='nodule_id')
+        data = pd.DataFrame(self.values, index=index, columns=self.columns)
+
+        # Keep the last values for duplicate nodule IDs (in order of first appearance)
+        if data.index.has_duplicates:
+            first_appearances = data.index[~data.index.duplicated(keep='first')]
+            data = data[~data.index.duplicated(keep='last')].reindex(first_appearances)
+
+        return data
+
+
+def featurize_scan(scan, featurizer_names=None, concurrency=1, processes=False,
+                   cache_folder=None):
+    """
+    Featurize the given scan, using all available featurizers (or only those in
+    `featurizer_names`). Intermediate products are computed only if required by one of the
+    featurizers, and are shared between them. Returns a pandas DataFrame with all featurizer
+    results, indexed by patient_id and nodule_id using a MultiIndex.
+
+    If `concurrency` is greater than one, up to `concurrency` featurizers are run at once on a
+    thread pool. If `processes` is true, a process pool is used instead: featurizers sharing
+    intermediate products run together in the same process, and the scan is shared with the
+    processes through shared memory (see `lcat.shared`) rather than being copied. Columns are always
+    ordered as in `featurizer_names` (or alphabetically by featurizer name).
+
+    If a cache folder is configured (see `lcat.cache.get_cache_folder`), the result of each
+    featurizer is persisted, and only featurizers without a result for the current featurizer
+    version and scan inputs are run. Cached intermediate products (such as segmentations) are
+    persisted to the same cache folder.
+    """
+    # Determine featurizers to run
+    featurizer_names = get_featurizer_names(featurizer_names)
+
+    # Look for cached featurizations
+    cache_folder = lcat.cache.get_cache_folder(cache_folder)
+    paths = {}
+    featurizations = {}
+    if cache_folder is not None:
+        for featurizer_name in featurizer_names:
+            paths[featurizer_name] = get_featurization_path(scan, featurizer_name, cache_folder)
+            featurization = load_featurization(paths[featurizer_name])
+            if featurization is not None:
+                featurizations[featurizer_name] = featurization
+    missing_names = [featurizer_name for featurizer_name in featurizer_names
+                     if featurizer_name not in featurizations]
+
+    # Run missing featurizers
+    if not missing_names:
+        missing_featurizations = []
+    elif concurrency > 1 and processes:
+        missing_featurizations = run_featurizers_in_processes(scan, missing_names, concurrency,
+                                                              cache_folder)
+    elif concurrency > 1:
+        missing_featurizations = run_featurizers_in_threads(scan, missing_names, concurrency,
+                                                            cache_folder)
+    else:
+        missing_featurizations = run_featurizers(scan, missing_names,
+                                                 cache_folder=cache_folder)
+
+    # Store new featurizations
+    for featurizer_name, featurization in zip(missing_names, missing_featurizations):
+        featurizations[featurizer_name] = featurization
+        if featurization is not None and featurizer_name in paths:
+            save_featurization(paths[featurizer_name], featurization)
+
+    # Drop failed featurizations
+    featurizations = [featurizations[featurizer_name] for featurizer_name in featurizer_names
+                      if featurizations[featurizer_name] is not None]
 
     # Concatenate all featurizations
     return pd.concat(featurizations, axis=1)
 
 
+def run_featurizers(scan, featurizer_names, store=None, cache_folder=None):
+    """
+    Run the featurizers `featurizer_names` on `scan` one after another, sharing intermediate
+    products through `store` (created with `cache_folder` if not given). Returns a list containing
+    the featurization produced by each featurizer, or None for featurizers which failed.
+    """
+    # Set up intermediate products
+    if store is None:
+        store = ProductStore(scan, featurizer_names, cache_folder)
+
+    return [try_featurizer(featurizer_name, store) for featurizer_name in featurizer_names]
+
+
+def run_featurizers_in_threads(scan, featurizer_names, concurrency, cache_folder=None):
+    """
+    Run the featurizers `featurizer_names` on `scan` using a pool of `concurrency` threads, sharing
+    intermediate products between threads. Returns a list as for `run_featurizers`.
+    """
+    # Set up intermediate products
+    store = ProductStore(scan, featurizer_names, cache_folder)
+
+    # Run featurizers on the thread pool
+    pool = multiprocessing.pool.ThreadPool(min(concurrency, len(featurizer_names)) or 1)
+    try:
+        return pool.map(lambda featurizer_name: try_featurizer(featurizer_name, store),
+                        featurizer_names, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def run_featurizers_in_processes(scan, featurizer_names, concurrency, cache_folder=None):
+    """
+    Run the featurizers `featurizer_names` on `scan` using a pool of `concurrency` processes. Each
+    group of featurizers sharing intermediate products (see `get_featurizer_groups`) runs in a
+    single process. Returns a list as for `run_featurizers`.
+    """
+    # Group featurizers by shared products
+    groups = get_featurizer_groups(featurizer_names)
+
+    # Share the scan with the processes
+    with lcat.shared.shared_scan(scan) as handle:
+        # Run groups on the process pool
+        pool = multiprocessing.Pool(min(concurrency, len(groups)) or 1)
+        try:
+            group_featurizations = pool.map(run_featurizer_group,
+                                            [(handle, group, cache_folder) for group in groups],
+                                            chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    # Restore the requested featurizer order
+    featurizations = {}
+    for group, group_results in zip(groups, group_featurizations):
+        featurizations.update(zip(group, group_results))
+
+    return [featurizations[featurizer_name] for featurizer_name in featurizer_names]
+
+
+def run_featurizer_group(arguments):
+    """
+    Process pool entry point for `run_featurizers_in_processes`. `arguments` contains the
+    `lcat.shared.ScanHandle` of the scan, the featurizer names to run and the cache folder of
+    cached products.
+    """
+    handle, featurizer_names, cache_folder = arguments
+
+    # Attach the shared scan
+    scan = lcat.shared.attach_scan(handle)
+    try:
+        return run_featurizers(scan, featurizer_names, cache_folder=cache_folder)
+    finally:
+        del scan
+        lcat.shared.detach_scan(handle)
+
+
+def try_featurizer(featurizer_name, store):
+    """
+    Run the featurizer `featurizer_name` using `store`, returning None (after reporting the error)
+    if it fails.
+    """
+    try:
+        return run_featurizer(featurizer_name, store)
+    except:
+        print("Error featurizing scan for patient '%s' using featurizer '%s', skipping..."
+              % (store.scan.patient_id, featurizer_name))
+        return None
+
+
+def get_featurization_path(scan, featurizer_name, cache_folder):
+    """
+    Return the path of the cached result of the featurizer `featurizer_name` for `scan` below
+    `cache_folder`, keyed by the featurizer version, the versions of the products it requires and
+    the fingerprints of its inputs.
+    """
+    # Fingerprint the inputs of the featurizer
+    inputs = FEATURIZER_INPUTS[featurizer_name]
+    fingerprints = []
+    if 'voxels' in inputs:
+        fingerprints.append(lcat.cache.get_scan_fingerprint(scan))
+    if 'nodules' in inputs:
+        fingerprints.append(lcat.cache.get_annotation_fingerprint(scan.nodules))
+
+    # Combine with the featurizer and product versions
+    key = lcat.cache.get_key(featurizer_name, FEATURIZER_VERSIONS[featurizer_name],
+                             get_product_versions(featurizer_name), fingerprints)
+
+    return lcat.cache.get_cache_path(cache_folder, os.path.join('featurizations', featurizer_name),
+                                     key)
+
+
+def get_product_versions(featurizer_name):
+    """
+    Return a sorted list of the name and version of each product required (directly or indirectly)
+    by the featurizer `featurizer_name`.
+    """
+    # Collect required products
+    product_names = set()
+    pending = list(FEATURIZER_REQUIREMENTS[featurizer_name])
+    while pending:
+        product_name = pending.pop()
+        if product_name not in product_names:
+            product_names.add(product_name)
+            pending.extend(PRODUCT_REQUIREMENTS[product_name])
+
+    return [[product_name, PRODUCT_VERSIONS[product_name]]
+            for product_name in sorted(product_names)]
+
+
+def save_featurization(path, featurization):
+    """
+    Store the featurizer result `featurization` (as returned by `ResultBuilder.to_frame`) at
+    `path`.
+    """
+    lcat.cache.save_arrays(path, values=featurization.values.astype(np.float64),
+                           nodule_ids=np.asarray([str(nodule_id)
+                                                  for nodule_id in featurization.index]),
+                           columns=np.asarray([str(column) for column in featurization.columns]))
+
+
+def load_featurization(path):
+    """
+    Load a featurizer result stored using `save_featurization`. Returns None if no readable entry
+    exists.
+    """
+    arrays = lcat.cache.load_arrays(path)
+    if arrays is None:
+        return None
+
+    # Rebuild dataframe
+    index = pd.Index(arrays['nodule_ids'].tolist(), name='nodule_id')
+    return pd.DataFrame(arrays['values'], index=index, columns=arrays['columns'].tolist())
+
+
 def featurize_scan_single(scan, featurizer_name):
     """
     Featurize the given scan, using the specified featurizer. Returns a pandas DataFrame with all
     featurizer results, indexed by patient_id and nodule_id using a MultiIndex.
     """
-    # Get the featurizer
-    featurizer = FEATURIZERS[featurizer_name]
+    # Set up intermediate products
+    featurizer_names = get_featurizer_names([featurizer_name])
+    store = ProductStore(scan, featurizer_names)
 
     # Featurize the scan
-    featurization = featurizer(scan)
+    featurization = run_featurizer(featurizer_name, store)
 
     return featurization
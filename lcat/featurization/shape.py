@@ -0,0 +1,70 @@
+"""
+Shape featurization module.
+"""
+from __future__ import absolute_import, division
+
+import numpy as np
+
+from . import registry
+
+
+SHAPE_PROPERTIES = [
+    'major_axis_length',
+    'intermediate_axis_length',
+    'minor_axis_length',
+    'elongation',
+    'flatness',
+    'orientation_x',
+    'orientation_y',
+    'orientation_z',
+]
+
+
+@registry.register_featurizer('shape', requires=['nodule_statistics'])
+def featurize_shape(scan, nodule_statistics):
+    """
+    Featurize the given scan, returning the principal axes of each nodule (in real space).
+    """
+    # Create data distance placeholder
+    data = registry.ResultBuilder(scan, SHAPE_PROPERTIES)
+
+    # Convert second-order moments to real space
+    unit_cell = np.asarray(scan.unit_cell, dtype=np.float64)
+    covariances = nodule_statistics.covariances * unit_cell[:, np.newaxis] * unit_cell
+
+    # For each nodule with voxels in the scan
+    for row in np.flatnonzero(nodule_statistics.counts > 0):
+        # Add attributes to dataframe
+        data[row] = calculate_shape_properties(covariances[row])
+
+    return data.to_frame()
+
+
+def calculate_shape_properties(covariance):
+    """
+    Calculate the principal axis lengths, elongation, flatness and major axis orientation (as in
+    `SHAPE_PROPERTIES`) of a region with the given 3x3 spatial `covariance`. Axis lengths are the
+    full axis lengths of the solid ellipsoid with the same second-order moments (as in
+    `skimage.measure.regionprops` for 3D regions).
+    """
+    # Decompose into principal axes (ordered from major to minor)
+    variances, axes = np.linalg.eigh(covariance)
+    variances = np.maximum(variances[::-1], 0)
+    axes = axes[:, ::-1]
+
+    # Calculate axis lengths (the variance of a solid ellipsoid along an axis is a fifth of its
+    # squared semi-axis length)
+    major_length, intermediate_length, minor_length = 2 * np.sqrt(5 * variances)
+
+    # Calculate axis ratios
+    with np.errstate(invalid='ignore', divide='ignore'):
+        elongation = intermediate_length / major_length
+        flatness = minor_length / major_length
+
+    # Orient the major axis consistently (largest component positive)
+    orientation = axes[:, 0]
+    if orientation[np.argmax(np.abs(orientation))] < 0:
+        orientation = -orientation
+
+    return [major_length, intermediate_length, minor_length, elongation, flatness] \
+        + list(orientation)
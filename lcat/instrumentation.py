@@ -0,0 +1,384 @@
+"""
+Per-stage timing and memory instrumentation for the lcat toolkit.
+
+Stages are delimited using the `stage` context manager or the `instrumented` function decorator.
+While instrumentation is enabled (see `enable`, or the `LCAT_TRACE_FILE` environment variable),
+each completed stage is appended to a JSON lines trace file as a record holding its wall time, the
+CPU time of the thread running it (excluding work delegated to other threads), the peak resident
+set size of the process and (if memory tracing is enabled) the peak memory allocated during the
+stage according to tracemalloc. As tracemalloc only measures the whole process, memory peaks are
+omitted (None) for stages which overlap with stages of other threads. Records are tagged using the
+`tagged` context manager (for example with the ID of the patient being processed). The trace file
+is shared by all processes inheriting the environment, and can be converted to the Chrome trace
+format using `write_chrome_trace`. While instrumentation is disabled, stages cost a single global
+lookup.
+"""
+from __future__ import absolute_import
+import contextlib
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+# Environment variable specifying the trace file (instrumentation is disabled if unset)
+TRACE_FILE_VARIABLE = 'LCAT_TRACE_FILE'
+
+# Environment variable enabling memory tracing using tracemalloc (if set to a non-empty value)
+TRACE_MEMORY_VARIABLE = 'LCAT_TRACE_MEMORY'
+
+# Trace file of this process (None while instrumentation is disabled)
+TRACE_FILE = os.environ.get(TRACE_FILE_VARIABLE) or None
+
+# Lock serializing writes to the trace file within this process
+TRACE_LOCK = threading.Lock()
+
+# Per-thread tags and open stages
+LOCAL = threading.local()
+
+# Open stages of all threads (guarded by `STAGES_LOCK`), used to detect overlapping stages
+OPEN_STAGES = []
+STAGES_LOCK = threading.Lock()
+
+
+class NullStage(object):
+    """
+    Stage context manager doing nothing, used while instrumentation is disabled.
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+# Shared disabled stage
+NULL_STAGE = NullStage()
+
+
+class Stage(object):
+    """
+    Context manager measuring a single stage named `name`, tagged with the current tags (see
+    `tagged`) and `tags`. The record is written to the trace file when the stage exits.
+    """
+    def __init__(self, name, tags):
+        self.name = name
+        self.tags = tags
+        self.memory_start = None
+        self.memory_peak = 0
+        self.thread = None
+        self.concurrent = False
+
+    def __enter__(self):
+        self.thread = threading.current_thread().ident
+
+        # Combine tags
+        tags = dict(get_tags())
+        tags.update(self.tags)
+        self.tags = tags
+
+        # Register the stage, marking it and the open stages as concurrent if they overlap with
+        # stages of other threads (as their process-wide memory peaks can't be told apart)
+        with STAGES_LOCK:
+            if any(stage.thread != self.thread for stage in OPEN_STAGES):
+                self.concurrent = True
+                for stage in OPEN_STAGES:
+                    stage.concurrent = True
+            OPEN_STAGES.append(self)
+
+        # Start memory measurement (recording the peak reached so far in enclosing stages)
+        if tracemalloc is not None and tracemalloc.is_tracing() and not self.concurrent:
+            current, peak = tracemalloc.get_traced_memory()
+            for stage in get_open_stages():
+                stage.memory_peak = max(stage.memory_peak, peak)
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            self.memory_start = self.memory_peak = current
+        get_open_stages().append(self)
+
+        # Start timing
+        self.start = time.time()
+        self.wall_start = get_wall_time()
+        self.cpu_start = get_thread_cpu_time()
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Stop timing
+        wall_time = get_wall_time() - self.wall_start
+        cpu_time = get_thread_cpu_time() - self.cpu_start
+
+        # Unregister the stage
+        get_open_stages().remove(self)
+        with STAGES_LOCK:
+            OPEN_STAGES.remove(self)
+
+        # Stop memory measurement (propagating the peak to enclosing stages)
+        memory_peak = None
+        if self.memory_start is not None and not self.concurrent and tracemalloc.is_tracing():
+            self.memory_peak = max(self.memory_peak, tracemalloc.get_traced_memory()[1])
+            for stage in get_open_stages():
+                stage.memory_peak = max(stage.memory_peak, self.memory_peak)
+            memory_peak = self.memory_peak - self.memory_start
+
+        # Write the record
+        write_record({
+            'name': self.name,
+            'start': self.start,
+            'wall_time': wall_time,
+            'cpu_time': cpu_time,
+            'max_rss': get_max_rss(),
+            'memory_peak': memory_peak,
+            'pid': os.getpid(),
+            'thread': threading.current_thread().ident,
+            'thread_name': threading.current_thread().name,
+            'concurrent': self.concurrent,
+            'tags': self.tags,
+            'error': None if exc_type is None else exc_type.__name__,
+        })
+
+        return False
+
+
+def is_enabled():
+    """
+    Return whether instrumentation is enabled in this process.
+    """
+    return TRACE_FILE is not None
+
+
+def enable(trace_file, trace_memory=False, append=False):
+    """
+    Enable instrumentation, writing records to `trace_file` (truncated unless `append` is true). If
+    `trace_memory` is true, memory allocations are traced using tracemalloc (which slows down
+    allocation-heavy code). Subprocesses started afterwards inherit these settings through the
+    environment.
+    """
+    global TRACE_FILE
+
+    # Prepare the trace file
+    if not append:
+        open(trace_file, 'w').close()
+    TRACE_FILE = os.path.abspath(trace_file)
+
+    # Propagate settings to subprocesses
+    os.environ[TRACE_FILE_VARIABLE] = TRACE_FILE
+    if trace_memory:
+        os.environ[TRACE_MEMORY_VARIABLE] = '1'
+    else:
+        os.environ.pop(TRACE_MEMORY_VARIABLE, None)
+
+    # Start memory tracing if requested
+    start_memory_tracing()
+
+
+def disable():
+    """
+    Disable instrumentation in this process and in subprocesses started afterwards.
+    """
+    global TRACE_FILE
+    TRACE_FILE = None
+    os.environ.pop(TRACE_FILE_VARIABLE, None)
+    os.environ.pop(TRACE_MEMORY_VARIABLE, None)
+
+
+def start_memory_tracing():
+    """
+    Start tracemalloc if instrumentation is enabled with memory tracing (see `enable`).
+    """
+    if (TRACE_FILE is not None and os.environ.get(TRACE_MEMORY_VARIABLE)
+            and tracemalloc is not None and not tracemalloc.is_tracing()):
+        tracemalloc.start()
+
+
+def stage(name, **tags):
+    """
+    Return a context manager measuring the stage `name` (see `Stage`), tagged with `tags` in
+    addition to the current tags.
+    """
+    if TRACE_FILE is None:
+        return NULL_STAGE
+
+    return Stage(name, tags)
+
+
+def instrumented(name=None):
+    """
+    Function decorator measuring each call of the decorated function as a stage named `name`
+    (defaulting to the name of the function).
+    """
+    def decorator(function):
+        """
+        Wrap `function` in a stage.
+        """
+        stage_name = name or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            # Skip measurement while disabled
+            if TRACE_FILE is None:
+                return function(*args, **kwargs)
+
+            with Stage(stage_name, {}):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@contextlib.contextmanager
+def tagged(**tags):
+    """
+    Context manager adding `tags` to the records of all stages of the current thread within the
+    context.
+    """
+    # Skip tagging while disabled
+    if TRACE_FILE is None:
+        yield
+        return
+
+    # Push tags
+    previous = get_tags()
+    combined = dict(previous)
+    combined.update(tags)
+    LOCAL.tags = combined
+
+    try:
+        yield
+    finally:
+        # Pop tags
+        LOCAL.tags = previous
+
+
+def get_tags():
+    """
+    Return the current tags of this thread.
+    """
+    return getattr(LOCAL, 'tags', {})
+
+
+def get_open_stages():
+    """
+    Return the stages currently open in this thread (outermost first).
+    """
+    stages = getattr(LOCAL, 'stages', None)
+    if stages is None:
+        stages = LOCAL.stages = []
+
+    return stages
+
+
+def write_record(record):
+    """
+    Append `record` to the trace file as a JSON line.
+    """
+    line = json.dumps(record, sort_keys=True, default=str) + '\n'
+    with TRACE_LOCK:
+        # Reopen the file for each record, so that records of concurrent processes aren't mixed
+        with open(TRACE_FILE, 'a') as trace_file:
+            trace_file.write(line)
+
+
+def load_records(trace_file):
+    """
+    Load the records written to the JSON lines `trace_file`.
+    """
+    with open(trace_file) as source:
+        return [json.loads(line) for line in source if line.strip()]
+
+
+def write_chrome_trace(records, destination_file):
+    """
+    Write `records` (see `load_records`) to `destination_file` in the Chrome trace event format
+    (viewable using chrome://tracing or Perfetto).
+    """
+    # Name each thread
+    events = []
+    threads = dict(((record['pid'], record['thread']), record['thread_name'])
+                   for record in records)
+    for (pid, thread), thread_name in sorted(threads.items()):
+        events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': thread,
+                       'args': {'name': thread_name}})
+
+    # Convert each record to a complete event (times in microseconds)
+    for record in records:
+        args = dict(record['tags'])
+        for key in ('cpu_time', 'max_rss', 'memory_peak', 'error'):
+            if record.get(key) is not None:
+                args[key] = record[key]
+        events.append({
+            'name': record['name'],
+            'ph': 'X',
+            'ts': record['start'] * 1e6,
+            'dur': record['wall_time'] * 1e6,
+            'pid': record['pid'],
+            'tid': record['thread'],
+            'args': args,
+        })
+
+    # Write the trace
+    with open(destination_file, 'w') as destination:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, destination)
+
+
+def get_wall_time():
+    """
+    Return a monotonic wall clock time (in seconds).
+    """
+    try:
+        return time.perf_counter()
+    except AttributeError:
+        return time.time()
+
+
+def get_cpu_time():
+    """
+    Return the CPU time used by this process (in seconds, including all of its threads).
+    """
+    try:
+        return time.process_time()
+    except AttributeError:
+        return time.clock()
+
+
+def get_thread_cpu_time():
+    """
+    Return the CPU time used by the current thread (in seconds), or by this process if per-thread
+    CPU time is unavailable.
+    """
+    try:
+        return time.thread_time()
+    except AttributeError:
+        return get_cpu_time()
+
+
+def get_max_rss():
+    """
+    Return the peak resident set size of this process (in bytes), or None if it's unavailable.
+    """
+    if resource is None:
+        return None
+
+    # Linux reports kilobytes, macOS bytes
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        max_rss *= 1024
+
+    return max_rss
+
+
+# Start memory tracing in subprocesses inheriting the settings
+start_memory_tracing()
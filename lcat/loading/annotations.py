@@ -14,6 +14,7 @@ import skimage.measure
 import skimage.segmentation
 
 import lcat
+import lcat.instrumentation
 
 
 # Nodule datatype
@@ -28,6 +29,7 @@ XMLNS = {
 TAG_NAME_RE = re.compile('^{' + XMLNS['nih'] + '}' + '(.+)$')
 
 
+@lcat.instrumentation.instrumented()
 def load_radiologist_annotations(dicom_folder, dimensions, sop_instance_uids):
     """
     Load radiologist annotations (namely nodule characteristics and regions) from the xml files
@@ -62,6 +64,30 @@ def load_radiologist_annotations(dicom_folder, dimensions, sop_instance_uids):
     return nodules
 
 
+def get_referenced_uids(dicom_folder):
+    """
+    Find the series and image instances referenced by the radiologist annotations in the xml files
+    present in `dicom_folder`. Returns a set of series instance UIDs and a set of SOP instance UIDs.
+    """
+    # Create UID placeholders
+    series_uids = set()
+    sop_instance_uids = set()
+
+    # Look for XML files
+    for filename in os.listdir(dicom_folder):
+        if filename.endswith('.xml'):
+            # Load xml file
+            root = ET.parse(os.path.join(dicom_folder, filename)).getroot()
+
+            # Collect referenced UIDs
+            for series_uid_elem in root.findall('.//nih:SeriesInstanceUid', XMLNS):
+                series_uids.add(series_uid_elem.text.strip())
+            for sop_instance_uid_elem in root.findall('.//nih:imageSOP_UID', XMLNS):
+                sop_instance_uids.add(sop_instance_uid_elem.text.strip())
+
+    return series_uids, sop_instance_uids
+
+
 def get_nodule_information(read, dimensions, sop_instance_uids):
     """
     Given an unblindedReadNodule element, create a Nodule object representing the nodule's
@@ -174,8 +200,10 @@ def mark_region(mask, roi_elem, sop_instance_uids):
         # Mark boundary in mask
         mask_boundary[x_position, y_position] = 1
 
-    # Fill in region
-    mask_regions = skimage.measure.label(mask_boundary, background=-1, connectivity=1)
+    # Fill in region (labeling integers, as boolean images are labeled ignoring `background` by
+    # recent versions of scikit-image)
+    mask_regions = skimage.measure.label(mask_boundary.astype(np.uint8), background=-1,
+                                         connectivity=1)
     mask_center = skimage.segmentation.clear_border(mask_regions)
     mask[:, :, z_index] |= mask_center != 0
 
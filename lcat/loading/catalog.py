@@ -0,0 +1,278 @@
+"""
+Catalog of the patients in a LIDC-IDRI data folder.
+
+The catalog is built in a single pass which reads only the DICOM headers and the radiologist XML
+files of each patient, and is stored in a local SQLite file. Each patient folder is fingerprinted
+by the names, sizes and modification times of its files, so updating the catalog only re-reads
+patients whose files changed. Schedulers and caches can then use the catalog to filter, order by
+size and detect changes without touching any DICOM file.
+"""
+from __future__ import absolute_import
+from collections import namedtuple
+import hashlib
+import os
+import re
+import sqlite3
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+import lcat.loading.annotations
+import lcat.loading.images
+
+
+# Version of the catalog contents (increment when changing how entries are computed)
+CATALOG_VERSION = 2
+
+# Patient folder name regex (capturing the patient ID)
+PATIENT_FOLDER_RE = re.compile('LIDC-IDRI-(.+)')
+
+# Catalog entry datatype (one per patient folder)
+# `series_uid` is the series loaded among the `series_count` series in the folder (see
+# `lcat.loading.images.select_series`), and the geometry fields describe that series. `error`
+# describes why the headers couldn't be read (in which case the geometry fields are None).
+CatalogEntry = namedtuple('CatalogEntry', [
+    'patient_id',
+    'path',
+    'fingerprint',
+    'file_count',
+    'file_bytes',
+    'dicom_patient_id',
+    'series_uid',
+    'series_count',
+    'slice_count',
+    'x_size',
+    'y_size',
+    'x_spacing',
+    'y_spacing',
+    'z_spacing',
+    'voxel_count',
+    'nodule_count',
+    'read_count',
+    'error',
+])
+
+# Catalog table definition
+CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS patients (
+    patient_id TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    file_count INTEGER,
+    file_bytes INTEGER,
+    dicom_patient_id TEXT,
+    series_uid TEXT,
+    series_count INTEGER,
+    slice_count INTEGER,
+    x_size INTEGER,
+    y_size INTEGER,
+    x_spacing REAL,
+    y_spacing REAL,
+    z_spacing REAL,
+    voxel_count INTEGER,
+    nodule_count INTEGER,
+    read_count INTEGER,
+    error TEXT,
+    catalog_version INTEGER NOT NULL
+)
+"""
+
+
+def generate_patient_paths(data_folder):
+    """
+    Yield a patient ID and path for each patient folder in data_folder.
+    """
+    # For every filename in data_folder
+    for filename in os.listdir(data_folder):
+        # Generate full path
+        filepath = os.path.join(data_folder, filename)
+
+        # Make sure it's a folder
+        if not os.path.isdir(filepath):
+            continue
+
+        # Perform regex matching
+        match = PATIENT_FOLDER_RE.match(filename)
+
+        # Reject improperly named folders
+        if match is None:
+            continue
+
+        # Yield patient ID and path
+        yield match.group(1), filepath
+
+
+def update_catalog(data_folder, catalog_path):
+    """
+    Bring the catalog at `catalog_path` up to date with the patient folders in `data_folder`,
+    reading the headers of new and changed patients only and removing patients which no longer
+    exist. Returns the list of `CatalogEntry`s of all patients, ordered by patient ID.
+    """
+    connection = open_catalog(catalog_path)
+    try:
+        # Load existing fingerprints
+        known = dict(connection.execute(
+            "SELECT patient_id, fingerprint FROM patients WHERE catalog_version = ?",
+            (CATALOG_VERSION,)))
+
+        # For each patient folder
+        patient_ids = set()
+        for patient_id, path in sorted(generate_patient_paths(data_folder)):
+            patient_ids.add(patient_id)
+
+            # Skip unchanged patients
+            fingerprint, file_count, file_bytes = get_folder_fingerprint(path)
+            if known.get(patient_id) == fingerprint:
+                continue
+
+            # Read headers
+            entry = read_patient(patient_id, path)._replace(
+                fingerprint=fingerprint, file_count=file_count, file_bytes=file_bytes)
+            store_entry(connection, entry)
+
+        # Remove vanished patients
+        for patient_id in set(known) - patient_ids:
+            connection.execute("DELETE FROM patients WHERE patient_id = ?", (patient_id,))
+        connection.commit()
+    finally:
+        connection.close()
+
+    return load_catalog(catalog_path)
+
+
+def load_catalog(catalog_path, where=None, parameters=(), order_by='patient_id'):
+    """
+    Load the `CatalogEntry`s stored at `catalog_path`. `where` is an optional SQL condition (using
+    `?` placeholders for `parameters`) used to filter patients, and `order_by` an SQL ordering (such
+    as `'voxel_count DESC'`).
+    """
+    # Build query
+    query = "SELECT %s FROM patients WHERE catalog_version = ?" % ', '.join(CatalogEntry._fields)
+    if where is not None:
+        query += " AND (%s)" % where
+    query += " ORDER BY %s" % order_by
+
+    # Load entries
+    connection = open_catalog(catalog_path)
+    try:
+        rows = connection.execute(query, (CATALOG_VERSION,) + tuple(parameters)).fetchall()
+    finally:
+        connection.close()
+
+    return [CatalogEntry(*row) for row in rows]
+
+
+def is_changed(entry):
+    """
+    Return whether the files of the patient described by the `CatalogEntry` `entry` changed since
+    it was cataloged.
+    """
+    if not os.path.isdir(entry.path):
+        return True
+
+    return get_folder_fingerprint(entry.path)[0] != entry.fingerprint
+
+
+def open_catalog(catalog_path):
+    """
+    Open the SQLite catalog at `catalog_path`, creating it if necessary.
+    """
+    connection = sqlite3.connect(catalog_path)
+    connection.execute(CATALOG_SCHEMA)
+
+    return connection
+
+
+def store_entry(connection, entry):
+    """
+    Insert or replace the `CatalogEntry` `entry` using `connection`.
+    """
+    fields = CatalogEntry._fields + ('catalog_version',)
+    connection.execute("INSERT OR REPLACE INTO patients (%s) VALUES (%s)"
+                       % (', '.join(fields), ', '.join('?' * len(fields))),
+                       tuple(entry) + (CATALOG_VERSION,))
+
+
+def get_folder_fingerprint(folder):
+    """
+    Fingerprint the files in `folder` by their names, sizes and modification times. Returns the
+    fingerprint, the number of files and their total size in bytes.
+    """
+    hasher = hashlib.sha1()
+    file_count = 0
+    file_bytes = 0
+
+    # For each file (in a stable order)
+    for filename in sorted(os.listdir(folder)):
+        path = os.path.join(folder, filename)
+        if not os.path.isfile(path):
+            continue
+
+        # Hash file metadata
+        status = os.stat(path)
+        hasher.update(repr((filename, status.st_size, int(status.st_mtime))).encode('utf-8'))
+        file_count += 1
+        file_bytes += status.st_size
+
+    return hasher.hexdigest(), file_count, file_bytes
+
+
+def read_patient(patient_id, path):
+    """
+    Create a `CatalogEntry` for the patient folder at `path` by reading only the DICOM headers and
+    the radiologist XML files. The fingerprint fields are left empty.
+    """
+    # Count nodules and reads
+    nodule_count, read_count = count_annotations(path)
+
+    try:
+        # Read headers grouped by series
+        series = lcat.loading.images.read_series_headers(path)
+        if not series:
+            raise ValueError("No DICOM files found")
+
+        # Choose the series which would be loaded
+        series_uid = lcat.loading.images.select_series(series, path)
+        headers = [header for _, header in series[series_uid]]
+
+        # Describe geometry
+        x_spacing, y_spacing = [float(step) for step in headers[0].PixelSpacing]
+        z_spacing = lcat.loading.images.get_slice_spacing(series[series_uid])
+        z_spacing = z_spacing if np.isfinite(z_spacing) else None
+        x_size, y_size = int(headers[0].Rows), int(headers[0].Columns)
+
+        return CatalogEntry(patient_id, path, None, None, None, str(headers[0].PatientID),
+                            series_uid, len(series), len(headers), x_size, y_size, x_spacing,
+                            y_spacing, z_spacing, x_size * y_size * len(headers), nodule_count,
+                            read_count, None)
+    except Exception as error:
+        return CatalogEntry(patient_id, path, None, None, None, None, None, None, None, None, None,
+                            None, None, None, None, nodule_count, read_count, repr(error))
+
+
+def count_annotations(path):
+    """
+    Count the distinct nodules and the reading sessions in the radiologist XML files in the folder
+    at `path`.
+    """
+    nodule_ids = set()
+    read_count = 0
+
+    # For each XML file
+    for filename in os.listdir(path):
+        if not filename.endswith('.xml'):
+            continue
+
+        # Parse annotations
+        try:
+            root = ET.parse(os.path.join(path, filename)).getroot()
+        except ET.ParseError:
+            continue
+
+        # Count reads and nodules
+        xmlns = lcat.loading.annotations.XMLNS
+        read_count += len(root.findall('.//nih:readingSession', xmlns))
+        for nodule_id_elem in root.findall('.//nih:unblindedReadNodule/nih:noduleID', xmlns):
+            nodule_ids.add(nodule_id_elem.text)
+
+    return len(nodule_ids), read_count
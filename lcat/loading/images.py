@@ -3,27 +3,50 @@ Authors: Connor Brinton and Scotty Fleming
 Load a CT scan from a series of dicom files.
 """
 import os
+import xml.etree.ElementTree as ET
 
 import dicom
 import numpy as np
 
+import lcat.instrumentation
+import lcat.loading.annotations
 
-def load_folder(dicom_folder):
+
+# Minimum magnitude of the z component of the slice normal for a series to be considered axial
+AXIAL_NORMAL_THRESHOLD = 0.9
+
+# Size (in bytes) above which dicom element values (such as pixel data) are only read on access
+DEFER_SIZE = 1024
+
+
+@lcat.instrumentation.instrumented()
+def load_folder(dicom_folder, series_uid=None):
     """
     Given a folder of dicom files, load them and return a 3D numpy array representing the scan.
     Pixel values are converted to Houndsfield units using the rescaling slope and intercept encoded
     in each dicom file.
+
+    If the folder contains several series, only the series `series_uid` (or the series chosen by
+    `select_series` if not given) is loaded. Each file is parsed once (see `read_series_headers`),
+    and only the pixels of the loaded series are read.
     """
     # Make sure folder exists
     if not os.path.isdir(dicom_folder):
         raise RuntimeError("The specified folder does not exist, or is a file.")
 
-    # List all dicom files
-    dicom_files = [filename for filename in os.listdir(dicom_folder) if filename.endswith(".dcm")]
-    dicom_paths = [os.path.join(dicom_folder, filename) for filename in dicom_files]
+    # Group dicom files by series
+    series = read_series_headers(dicom_folder)
+    if not series:
+        raise RuntimeError("The specified folder does not contain any dicom files.")
 
-    # Load each dicom object
-    dicom_objects = [dicom.read_file(dicom_path) for dicom_path in dicom_paths]
+    # Choose the series
+    if series_uid is None:
+        series_uid = select_series(series, dicom_folder)
+    elif series_uid not in series:
+        raise RuntimeError("The specified folder does not contain series %s." % series_uid)
+    # Reuse the parsed dicom objects (pixel data is read on access)
+    dicom_objects = [dicom_object for _, dicom_object in series[series_uid]]
+    del series
 
     # Sort by instance number
     dicom_objects.sort(key=lambda x: x.InstanceNumber)
@@ -63,6 +86,109 @@ def load_folder(dicom_folder):
     return patient_id, voxels, unit_cell, sop_instance_uids
 
 
+def read_header(dicom_path):
+    """
+    Read the dicom file at `dicom_path`, deferring the reading of element values larger than
+    `DEFER_SIZE` (such as its pixel data) until they are accessed.
+    """
+    return dicom.read_file(dicom_path, defer_size=DEFER_SIZE)
+
+
+@lcat.instrumentation.instrumented()
+def read_series_headers(dicom_folder):
+    """
+    Read the headers of the dicom files in `dicom_folder` (see `read_header`), grouped by series.
+    Returns a dictionary mapping each series instance UID to a list of paths and headers. Headers
+    are complete dicom objects, whose pixel data is only read when accessed.
+    """
+    # Create series placeholder
+    series = {}
+
+    # For each dicom file
+    for filename in sorted(os.listdir(dicom_folder)):
+        if not filename.endswith(".dcm"):
+            continue
+
+        # Read header
+        dicom_path = os.path.join(dicom_folder, filename)
+        header = read_header(dicom_path)
+
+        # Add to series
+        series.setdefault(header.SeriesInstanceUID, []).append((dicom_path, header))
+
+    return series
+
+
+def select_series(series, dicom_folder=None):
+    """
+    Choose the series to load among `series` (as returned by `read_series_headers`). The series
+    referenced by the radiologist annotations in `dicom_folder` (by series UID, or else by the most
+    annotated images) is preferred. Otherwise, the axial series with the thinnest slices is chosen
+    (ignoring single-image series such as localizers where possible), with ties broken by slice
+    count. Returns the UID of the chosen series.
+    """
+    # A single series needs no choice
+    if len(series) == 1:
+        return next(iter(series))
+
+    # Prefer series referenced by annotations
+    if dicom_folder is not None:
+        try:
+            series_uids, sop_instance_uids = \
+                lcat.loading.annotations.get_referenced_uids(dicom_folder)
+        except ET.ParseError:
+            # Fall back to the default choice if annotations can't be parsed
+            series_uids, sop_instance_uids = set(), set()
+        referenced = [series_uid for series_uid in sorted(series) if series_uid in series_uids]
+        if referenced:
+            return referenced[0]
+
+        # Count annotated images of each series
+        annotated_counts = {series_uid: sum(header.SOPInstanceUID in sop_instance_uids
+                                            for _, header in headers)
+                            for series_uid, headers in series.items()}
+        if max(annotated_counts.values()) > 0:
+            return max(sorted(series), key=lambda series_uid: annotated_counts[series_uid])
+
+    # Restrict to axial volumes where possible
+    candidates = [series_uid for series_uid in sorted(series)
+                  if len(series[series_uid]) > 1 and is_axial(series[series_uid][0][1])]
+    if not candidates:
+        candidates = sorted(series)
+
+    # Choose the thinnest slices (then the most slices)
+    return min(candidates, key=lambda series_uid: (get_slice_spacing(series[series_uid]),
+                                                   -len(series[series_uid])))
+
+
+def is_axial(header):
+    """
+    Return whether the dicom `header` describes an axial image (assuming so if its orientation isn't
+    recorded).
+    """
+    orientation = getattr(header, 'ImageOrientationPatient', None)
+    if orientation is None:
+        return True
+
+    # Compute the slice normal
+    normal = np.cross(np.asarray(orientation[:3], dtype=float),
+                      np.asarray(orientation[3:], dtype=float))
+
+    return abs(normal[2]) >= AXIAL_NORMAL_THRESHOLD
+
+
+def get_slice_spacing(headers):
+    """
+    Return the median separation between the slices of a series from its paths and headers (or
+    infinity for a single slice).
+    """
+    slice_positions = np.sort([float(header.ImagePositionPatient[2]) for _, header in headers])
+    if len(slice_positions) < 2:
+        return float('inf')
+
+    return float(np.median(np.diff(slice_positions)))
+
+
 def get_single_value(values):
     """
     Given a sequence of values, checks that all values are the same, and then returns the single
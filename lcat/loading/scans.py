@@ -9,6 +9,7 @@ import warnings
 import numpy as np
 import scipy.ndimage
 
+import lcat.instrumentation
 import lcat.loading.annotations
 import lcat.loading.images
 
@@ -17,6 +18,7 @@ import lcat.loading.images
 Scan = namedtuple('Scan', ['patient_id', 'voxels', 'nodules', 'unit_cell'])
 
 
+@lcat.instrumentation.instrumented()
 def load_scan(scan_folder, cubify=False):
     """
     Loads the CT scan as a 3d voxel array, then loads the segmentation in the given dicom_folder by
@@ -44,6 +46,7 @@ def load_scan(scan_folder, cubify=False):
     return scan
 
 
+@lcat.instrumentation.instrumented()
 def cubify_scan(scan):
     """
     Given a scan, interpolate the data to make the unit cell cubic. The dimension(s) with the
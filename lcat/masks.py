@@ -0,0 +1,313 @@
+"""
+Bit-packed boolean volumes for the lcat toolkit.
+"""
+from __future__ import division
+
+import numpy as np
+
+
+# Number of set bits in each possible byte value
+POPCOUNT_TABLE = np.array([bin(value).count('1') for value in range(256)], dtype=np.uint8)
+
+# Number of rows counted at once when computing a popcount
+POPCOUNT_CHUNK_ROWS = 64
+
+
+class PackedMask(object):
+    """
+    A 3D binary mask stored with eight voxels per byte along the last (z) axis using
+    `np.packbits`. Supports the bitwise operators `&`, `|`, `^` and `~` against other packed masks
+    or dense boolean arrays, popcounts, bounding boxes and basic slicing. Dense arrays are obtained
+    using `to_dense` or `np.asarray`.
+
+    Padding bits in the final byte of each z column are always kept cleared, so that bytes can be
+    combined and counted directly.
+    """
+    # Make numpy defer binary operators with dense arrays to this class
+    __array_ufunc__ = None
+
+    def __init__(self, bits, shape):
+        # Make sure the packed representation matches the shape
+        shape = tuple(int(dim) for dim in shape)
+        if bits.shape != shape[:-1] + (get_packed_length(shape[-1]),):
+            raise ValueError("Packed bits of shape %s do not match mask shape %s."
+                             % (bits.shape, shape))
+
+        self.bits = bits
+        self.shape = shape
+
+    @classmethod
+    def from_dense(cls, mask):
+        """
+        Create a `PackedMask` from a dense array, treating all non-zero values as set.
+        """
+        # Make sure we have a boolean array
+        mask = np.asarray(mask, dtype=bool)
+
+        return cls(np.packbits(mask, axis=-1), mask.shape)
+
+    @classmethod
+    def zeros(cls, shape):
+        """
+        Create an empty `PackedMask` with the given `shape`.
+        """
+        shape = tuple(shape)
+        return cls(np.zeros(shape[:-1] + (get_packed_length(shape[-1]),), dtype=np.uint8), shape)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+
+    def to_dense(self):
+        """
+        Return the mask as a dense boolean array.
+        """
+        # Unpack all bits (including padding)
+        unpacked = np.unpackbits(self.bits, axis=-1)
+
+        # Drop padding bits
+        return unpacked[..., :self.shape[-1]].view(bool)
+
+    def __array__(self, dtype=None, copy=None):
+        dense = self.to_dense()
+
+        if dtype is not None:
+            dense = dense.astype(dtype, copy=False)
+
+        return dense
+
+    def __repr__(self):
+        return "PackedMask(shape=%s, count=%d)" % (self.shape, self.count())
+
+    def __len__(self):
+        return self.shape[0]
+
+    def copy(self):
+        """
+        Return a copy of the mask.
+        """
+        return PackedMask(self.bits.copy(), self.shape)
+
+    def count(self):
+        """
+        Return the number of set voxels in the mask.
+        """
+        # Sum popcounts in chunks to bound temporary memory
+        total = 0
+        for start in range(0, self.bits.shape[0], POPCOUNT_CHUNK_ROWS):
+            chunk = self.bits[start:start + POPCOUNT_CHUNK_ROWS]
+            total += int(np.sum(POPCOUNT_TABLE[chunk], dtype=np.int64))
+
+        return total
+
+    def any(self):
+        """
+        Return whether any voxel in the mask is set.
+        """
+        return bool(self.bits.any())
+
+    def get_bounding_box(self):
+        """
+        Return a list of tuples representing the extent of the set voxels along each axis, in the
+        same format as `lcat.util.get_bounding_box`.
+        """
+        # Boundaries placeholder
+        boundaries = []
+
+        # For each unpacked axis
+        for axis in range(self.ndim - 1):
+            # Enumerate orthogonal axes
+            other_axes = tuple(other_axis for other_axis in range(self.ndim) if other_axis != axis)
+
+            # Identify non-zero points
+            nonzero = np.any(self.bits, axis=other_axes)
+
+            # Store boundary
+            boundaries.append(tuple(np.where(nonzero)[0][[0, -1]]))
+
+        # Collapse packed axis by combining all columns
+        columns = self.bits.reshape(-1, self.bits.shape[-1])
+        combined = np.bitwise_or.reduce(columns, axis=0)
+        nonzero = np.unpackbits(combined)[:self.shape[-1]]
+
+        # Store packed axis boundary
+        boundaries.append(tuple(np.where(nonzero)[0][[0, -1]]))
+
+        return boundaries
+
+    def __getitem__(self, key):
+        """
+        Index the mask. Slicing along all three axes returns a `PackedMask`, while any other
+        indexing operation returns a dense array.
+        """
+        # Fall back to dense indexing for anything other than basic indexing
+        basic_key = normalize_key(key, self.ndim)
+        if basic_key is None:
+            return self.to_dense()[key]
+        key = basic_key
+
+        # Index unpacked axes directly
+        bits = self.bits[key[:-1]]
+        z_key = key[-1]
+
+        # Check whether the result remains three dimensional
+        if bits.ndim == self.ndim and isinstance(z_key, slice):
+            start, stop, step = z_key.indices(self.shape[-1])
+            length = len(range(start, stop, step))
+
+            # Slice byte-aligned ranges without unpacking
+            if step == 1 and start % 8 == 0:
+                end_byte = get_packed_length(start + length)
+                result = PackedMask(bits[..., start // 8:end_byte].copy(),
+                                    bits.shape[:-1] + (length,))
+                result.clear_padding()
+                return result
+
+            # Otherwise unpack only the bytes covering the range
+            return PackedMask.from_dense(unpack_range(bits, z_key, self.shape[-1]))
+
+        # Single voxel or lower dimensional selections are returned densely
+        return unpack_range(bits, z_key, self.shape[-1])
+
+    def clear_padding(self):
+        """
+        Clear the padding bits in the final byte of each z column, in place.
+        """
+        remainder = self.shape[-1] % 8
+        if remainder and self.bits.size:
+            self.bits[..., -1] &= np.uint8((0xFF << (8 - remainder)) & 0xFF)
+
+    def _get_other_bits(self, other):
+        """
+        Return the packed bits for `other`, which may be a `PackedMask` or a dense array.
+        """
+        if not isinstance(other, PackedMask):
+            other = PackedMask.from_dense(np.broadcast_to(other, self.shape))
+
+        if other.shape != self.shape:
+            raise ValueError("Mask shapes %s and %s do not match." % (self.shape, other.shape))
+
+        return other.bits
+
+    def __and__(self, other):
+        return PackedMask(self.bits & self._get_other_bits(other), self.shape)
+
+    def __or__(self, other):
+        return PackedMask(self.bits | self._get_other_bits(other), self.shape)
+
+    def __xor__(self, other):
+        return PackedMask(self.bits ^ self._get_other_bits(other), self.shape)
+
+    __rand__ = __and__
+    __ror__ = __or__
+    __rxor__ = __xor__
+
+    def __iand__(self, other):
+        self.bits &= self._get_other_bits(other)
+        return self
+
+    def __ior__(self, other):
+        self.bits |= self._get_other_bits(other)
+        return self
+
+    def __ixor__(self, other):
+        self.bits ^= self._get_other_bits(other)
+        return self
+
+    def __invert__(self):
+        result = PackedMask(np.invert(self.bits), self.shape)
+        result.clear_padding()
+        return result
+
+
+def get_packed_length(length):
+    """
+    Return the number of bytes required to pack `length` bits.
+    """
+    return (length + 7) // 8
+
+
+def normalize_key(key, ndim):
+    """
+    Expand a basic indexing `key` into a tuple with one integer or slice per axis. Returns None if
+    `key` uses advanced indexing.
+    """
+    # Wrap single keys
+    if not isinstance(key, tuple):
+        key = (key,)
+
+    # Reject advanced indexing
+    for item in key:
+        if item is not Ellipsis and not isinstance(item, (slice, int, np.integer)):
+            return None
+
+    # Expand ellipsis
+    if Ellipsis in key:
+        position = key.index(Ellipsis)
+        fill = (slice(None),) * (ndim - len(key) + 1)
+        key = key[:position] + fill + key[position + 1:]
+
+    # Pad trailing axes
+    key = key + (slice(None),) * (ndim - len(key))
+
+    if len(key) != ndim:
+        raise IndexError("Too many indices for mask.")
+
+    return key
+
+
+def unpack_range(bits, z_key, length):
+    """
+    Unpack only the bytes of `bits` required to evaluate `z_key` along the last axis of a mask with
+    `length` voxels along that axis, returning a dense boolean array.
+    """
+    # Single index
+    if not isinstance(z_key, slice):
+        z_index = int(z_key)
+        if z_index < 0:
+            z_index += length
+        if not 0 <= z_index < length:
+            raise IndexError("Index %d is out of bounds for axis of size %d." % (z_key, length))
+
+        return ((bits[..., z_index // 8] >> (7 - z_index % 8)) & 1).astype(bool)
+
+    # Determine covered bytes
+    start, stop, step = z_key.indices(length)
+    indices = np.arange(start, stop, step)
+    if len(indices) == 0:
+        return np.zeros(bits.shape[:-1] + (0,), dtype=bool)
+
+    first_byte = indices.min() // 8
+    last_byte = indices.max() // 8
+
+    # Unpack covered bytes and select
+    unpacked = np.unpackbits(bits[..., first_byte:last_byte + 1], axis=-1)
+    return unpacked[..., indices - 8 * first_byte].view(bool)
+
+
+def pack(mask):
+    """
+    Return `mask` as a `PackedMask`, packing it if necessary.
+    """
+    if isinstance(mask, PackedMask):
+        return mask
+
+    return PackedMask.from_dense(mask)
+
+
+def unpack(mask):
+    """
+    Return `mask` as a dense boolean array, unpacking it if necessary.
+    """
+    if isinstance(mask, PackedMask):
+        return mask.to_dense()
+
+    return np.asarray(mask, dtype=bool)
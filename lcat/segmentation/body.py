@@ -7,25 +7,41 @@ import skimage.measure
 import skimage.segmentation
 
 import lcat
+import lcat.cache
+import lcat.instrumentation
 
 
-def get_body_segmentation(scan):
+# Version of the segmentation algorithm (increment when changing results)
+SEGMENTATION_VERSION = 1
+
+
+@lcat.instrumentation.instrumented()
+@lcat.cache.cached_mask('body_segmentation', SEGMENTATION_VERSION)
+def get_body_segmentation(scan, packed=False):
     """
     Given a `Scan` object representing a chest CT scan, return a binary mask representing the region
-    occupied by the body.
+    occupied by the body. If `packed` is true, the mask is returned as a `lcat.masks.PackedMask`.
+    Results are cached persistently if a cache folder is configured (see
+    `lcat.cache.cached_mask`).
     """
     # Threshold the image (threshold is lower limit for lung tissue in HU)
     foreground = scan.voxels >= -700
 
     # Identify strongly connected components
     labels = skimage.measure.label(foreground, connectivity=1)
+    del foreground
 
     # Identify the largest volume
     body_mask = get_largest_volume(labels)
+    del labels
 
     # Obtain body envelope
     envelope_mask = get_body_envelope(body_mask)
 
+    # Pack if requested
+    if packed:
+        return lcat.masks.pack(envelope_mask)
+
     return envelope_mask
 
 
@@ -59,6 +75,7 @@ def get_body_envelope(body_mask):
 
     # Identify connected_components
     reversed_labels = skimage.measure.label(reversed_mask)
+    del reversed_mask
 
     # Identify inner labels only (on x and y edges, z outer labels can remain)
     inner_labels = lcat.util.clear_border(reversed_labels, axis=[0, 1])
@@ -10,12 +10,22 @@ import skimage.morphology
 import skimage.segmentation
 
 import lcat
+import lcat.cache
+import lcat.instrumentation
 
 
-def get_lung_segmentation(scan):
+# Version of the segmentation algorithm (increment when changing results)
+SEGMENTATION_VERSION = 1
+
+
+@lcat.instrumentation.instrumented()
+@lcat.cache.cached_mask('lung_segmentation', SEGMENTATION_VERSION)
+def get_lung_segmentation(scan, packed=False):
     """
     Given a `Scan` object representing a chest CT scan, return a binary mask representing the lungs
-    (not including the air within the lungs).
+    (not including the air within the lungs). If `packed` is true, the mask is returned as a
+    `lcat.masks.PackedMask`. Results are cached persistently if a cache folder is configured (see
+    `lcat.cache.cached_mask`).
     """
     # Identify filler pixels (top edge value)
     filler_value = get_top_value(np.concatenate((scan.voxels[[0, -1], :, :].flat,
@@ -24,6 +34,7 @@ def get_lung_segmentation(scan):
     # Determine threshold
     scan_mask = np.logical_not(np.isclose(scan.voxels, filler_value))
     threshold = skimage.filters.threshold_otsu(scan.voxels[scan_mask])
+    del scan_mask
 
     # Make sure threshold is within air/lung parameters
     if threshold <= -1000 or threshold >= 0:
@@ -34,12 +45,14 @@ def get_lung_segmentation(scan):
 
     # Identify strongly connected components
     labels = skimage.measure.label(foreground, background=1, connectivity=1)
+    del foreground
 
     # Remove edge components
     lcat.util.clear_border(labels, axis=[0, 1], in_place=True)
 
     # Identify the largest volume
     lung_mask = get_largest_volume(labels)
+    del labels
 
     # Fill edge holes by dilation
     # smoother = skimage.morphology.ball(10, dtype=bool)
@@ -59,6 +72,10 @@ def get_lung_segmentation(scan):
         lung_mask[..., z_index] = skimage.morphology.binary_erosion(envelope_mask[..., z_index],
                                                                     selem=smoother)
 
+    # Pack if requested
+    if packed:
+        return lcat.masks.pack(envelope_mask)
+
     return envelope_mask
 
 
@@ -92,6 +109,7 @@ def get_lung_envelope(lung_mask):
 
     # Identify connected_components
     reversed_labels = skimage.measure.label(reversed_mask)
+    del reversed_mask
 
     # Identify inner labels only
     inner_labels = lcat.util.clear_border(reversed_labels, axis=[0, 1])
@@ -0,0 +1,251 @@
+"""
+Zero-copy sharing of scans between processes.
+
+A scan is published by copying its voxels and nodule masks into a single shared memory segment
+(`multiprocessing.shared_memory` where available, or a memory-mapped file otherwise). Publishing
+returns a lightweight, picklable `ScanHandle`, from which any process can reconstruct a read-only
+`Scan` backed by the shared segment using `attach_scan`. The segment is removed once the publishing
+process has released all of its references (see `acquire_scan` and `release_scan`).
+"""
+from __future__ import absolute_import
+from collections import namedtuple
+import contextlib
+import os
+import tempfile
+import threading
+
+import numpy as np
+
+import lcat.loading.annotations
+import lcat.loading.scans
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+
+# Folder holding file-backed segments if shared memory isn't available (memory-backed if possible)
+SEGMENT_FOLDER = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+# Alignment (in bytes) of each array within a segment
+ARRAY_ALIGNMENT = 64
+
+# Shared array datatype (`offset` in bytes within the segment, `dtype` as a dtype string)
+ArrayHandle = namedtuple('ArrayHandle', ['offset', 'shape', 'dtype'])
+
+# Shared nodule datatype (as `lcat.loading.annotations.Nodule`, with `mask` as an `ArrayHandle`)
+NoduleHandle = namedtuple('NoduleHandle', ['nodule_id', 'characteristics', 'origin', 'mask'])
+
+# Shared scan datatype (as `lcat.loading.scans.Scan`, with `voxels` as an `ArrayHandle`, `nodules`
+# as a list of `NoduleHandle`s and `segment` naming the shared segment)
+ScanHandle = namedtuple('ScanHandle', ['segment', 'patient_id', 'voxels', 'nodules', 'unit_cell'])
+
+# Segments published by this process (by name, as [segment, reference count, process ID])
+PUBLISHED = {}
+
+# Segments attached by this process (by name, as [segment, reference count])
+ATTACHED = {}
+
+# Lock guarding the segment registries
+SEGMENTS_LOCK = threading.Lock()
+
+
+class FileSegment(object):
+    """
+    Memory-mapped file providing the interface of `multiprocessing.shared_memory.SharedMemory`
+    (`name`, `buf`, `close` and `unlink`), used when shared memory isn't available.
+    """
+    def __init__(self, name=None, create=False, size=0):
+        # Create the backing file if requested
+        if create:
+            handle, name = tempfile.mkstemp(prefix='lcat-', suffix='.shm', dir=SEGMENT_FOLDER)
+            os.close(handle)
+            with open(name, 'r+b') as segment_file:
+                segment_file.truncate(size)
+
+        self.name = name
+        self.buf = np.memmap(name, dtype=np.uint8, mode='r+')
+
+    def close(self):
+        """
+        Unmap the file (arrays created from the buffer keep it mapped until they are freed).
+        """
+        self.buf = None
+
+    def unlink(self):
+        """
+        Remove the backing file.
+        """
+        os.remove(self.name)
+
+
+def create_segment(size):
+    """
+    Create a new shared segment of at least `size` bytes.
+    """
+    size = max(size, 1)
+    if shared_memory is None:
+        return FileSegment(create=True, size=size)
+
+    return shared_memory.SharedMemory(create=True, size=size)
+
+
+def open_segment(name):
+    """
+    Open the existing shared segment `name` created by another process.
+    """
+    if shared_memory is None:
+        return FileSegment(name)
+
+    # Attaching processes must not remove the segment when they exit (before Python 3.13, this is
+    # only guaranteed for child processes, which share the resource tracker of their parent)
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
+
+
+def get_array(segment, handle):
+    """
+    Return a read-only array viewing the `ArrayHandle` `handle` within `segment`.
+    """
+    arr = np.ndarray(handle.shape, dtype=np.dtype(handle.dtype), buffer=segment.buf,
+                     offset=handle.offset)
+    arr.flags.writeable = False
+
+    return arr
+
+
+def publish_scan(scan):
+    """
+    Copy the voxels and nodule masks of `scan` into a new shared segment, returning a `ScanHandle`
+    which can be passed to other processes and attached using `attach_scan`. The handle starts with
+    a single reference, which must be released using `release_scan`.
+    """
+    # Lay out arrays within the segment
+    arrays = [np.asarray(scan.voxels)] + [np.asarray(nodule.mask) for nodule in scan.nodules]
+    offsets = []
+    size = 0
+    for arr in arrays:
+        size += -size % ARRAY_ALIGNMENT
+        offsets.append(size)
+        size += arr.nbytes
+
+    # Copy arrays into the segment
+    segment = create_segment(size)
+    array_handles = []
+    for arr, offset in zip(arrays, offsets):
+        array_handle = ArrayHandle(offset, arr.shape, arr.dtype.str)
+        view = np.ndarray(arr.shape, dtype=arr.dtype, buffer=segment.buf, offset=offset)
+        view[...] = arr
+        del view
+        array_handles.append(array_handle)
+
+    # Register the segment
+    with SEGMENTS_LOCK:
+        PUBLISHED[segment.name] = [segment, 1, os.getpid()]
+
+    # Describe nodules
+    nodule_handles = [NoduleHandle(nodule.nodule_id, nodule.characteristics, nodule.origin,
+                                   mask_handle)
+                      for nodule, mask_handle in zip(scan.nodules, array_handles[1:])]
+
+    return ScanHandle(segment.name, scan.patient_id, array_handles[0], nodule_handles,
+                      scan.unit_cell)
+
+
+def acquire_scan(handle):
+    """
+    Add a reference to the scan published as `handle` by this process.
+    """
+    with SEGMENTS_LOCK:
+        PUBLISHED[handle.segment][1] += 1
+
+
+def release_scan(handle):
+    """
+    Release a reference to the scan published as `handle` by this process, removing the shared
+    segment once no references remain. Scans attached in other processes remain valid until they
+    are detached.
+    """
+    with SEGMENTS_LOCK:
+        entry = PUBLISHED[handle.segment]
+        entry[1] -= 1
+        if entry[1] > 0:
+            return
+        del PUBLISHED[handle.segment]
+
+    # Remove the segment
+    segment = entry[0]
+    close_segment(segment)
+    segment.unlink()
+
+
+def attach_scan(handle):
+    """
+    Reconstruct the `Scan` published as `handle`, with voxels and nodule masks viewing the shared
+    segment (without copying). The arrays are read-only. Call `detach_scan` once the scan is no
+    longer needed.
+    """
+    with SEGMENTS_LOCK:
+        # Use the publishing segment directly within the publishing process
+        entry = PUBLISHED.get(handle.segment)
+        if entry is not None and entry[2] == os.getpid():
+            segment = entry[0]
+        else:
+            # Open the segment (once per process)
+            entry = ATTACHED.get(handle.segment)
+            if entry is None:
+                entry = ATTACHED[handle.segment] = [open_segment(handle.segment), 0]
+            entry[1] += 1
+            segment = entry[0]
+
+    # Rebuild the scan
+    nodules = [lcat.loading.annotations.Nodule(nodule.nodule_id, nodule.characteristics,
+                                               nodule.origin, get_array(segment, nodule.mask))
+               for nodule in handle.nodules]
+
+    return lcat.loading.scans.Scan(handle.patient_id, get_array(segment, handle.voxels), nodules,
+                                   handle.unit_cell)
+
+
+def detach_scan(handle):
+    """
+    Release a scan attached using `attach_scan`, closing the shared segment once no attached scans
+    remain in this process.
+    """
+    with SEGMENTS_LOCK:
+        entry = ATTACHED.get(handle.segment)
+        if entry is None:
+            return
+        entry[1] -= 1
+        if entry[1] > 0:
+            return
+        del ATTACHED[handle.segment]
+
+    close_segment(entry[0])
+
+
+def close_segment(segment):
+    """
+    Close `segment`, leaving it open if arrays viewing it are still alive (it is then closed when
+    they are freed).
+    """
+    try:
+        segment.close()
+    except BufferError:
+        pass
+
+
+@contextlib.contextmanager
+def shared_scan(scan):
+    """
+    Context manager publishing `scan` for the duration of the context (see `publish_scan`), and
+    providing its `ScanHandle`.
+    """
+    handle = publish_scan(scan)
+    try:
+        yield handle
+    finally:
+        release_scan(handle)
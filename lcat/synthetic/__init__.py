@@ -0,0 +1,7 @@
+"""
+Synthetic data package of the Lung Cancer Action Team toolkit.
+"""
+from __future__ import absolute_import
+
+from .dataset import write_dataset
+from .phantom import make_phantom
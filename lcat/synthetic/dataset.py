@@ -0,0 +1,247 @@
+"""
+Synthetic LIDC-IDRI datasets written to disk.
+
+Each patient folder (named `LIDC-IDRI-<patient ID>`) contains one DICOM file per slice of a
+synthetic phantom (see `lcat.synthetic.phantom`), with the headers and rescale tags read by
+`lcat.loading.images`, and an NIH-namespace XML file with one reading session per reader. Each
+reader outlines every nodule slice by slice using `edgeMap` contours, as read by
+`lcat.loading.annotations`. Readers disagree slightly on the extent of each nodule.
+"""
+from __future__ import division
+import os
+import uuid
+import xml.etree.ElementTree as ET
+
+import numpy as np
+import scipy.ndimage
+
+import lcat.loading.annotations
+from . import phantom
+
+
+# Patient folder name format
+PATIENT_FOLDER_FORMAT = 'LIDC-IDRI-%04d'
+
+# DICOM UIDs of CT images and of the explicit VR little endian transfer syntax
+CT_IMAGE_STORAGE_UID = '1.2.840.10008.5.1.4.1.1.2'
+EXPLICIT_VR_LITTLE_ENDIAN_UID = '1.2.840.10008.1.2.1'
+
+# Rescale intercept of the stored pixel values (stored as signed 16 bit integers)
+RESCALE_INTERCEPT = -1024
+
+# Name of the annotation file within each patient folder
+ANNOTATION_FILENAME = '069.xml'
+
+
+def write_dataset(data_folder, patient_count=1, shape=phantom.DEFAULT_SHAPE,
+                  unit_cell=phantom.DEFAULT_UNIT_CELL, nodule_count=4, reader_count=4, seed=0):
+    """
+    Write a synthetic LIDC-IDRI dataset of `patient_count` patients to `data_folder`. Each patient
+    is a phantom of the given `shape` (the last axis being the slice count) and `unit_cell`,
+    containing `nodule_count` nodules annotated by each of `reader_count` readers. Returns the list
+    of patient folders.
+    """
+    # Patient folders placeholder
+    patient_folders = []
+
+    # For each patient
+    for index in range(patient_count):
+        # Generate the phantom
+        patient_id = PATIENT_FOLDER_FORMAT % (index + 1)
+        scan = phantom.make_phantom(shape, unit_cell, nodule_count, seed=seed + index,
+                                    patient_id=patient_id)
+
+        # Write the patient folder
+        patient_folder = os.path.join(data_folder, patient_id)
+        write_patient(patient_folder, scan, reader_count, seed=seed + index)
+        patient_folders.append(patient_folder)
+
+    return patient_folders
+
+
+def write_patient(patient_folder, scan, reader_count=4, seed=0):
+    """
+    Write the `lcat.loading.scans.Scan` `scan` to `patient_folder` as DICOM slices, along with an
+    annotation file in which each of `reader_count` readers outlines every nodule of the scan.
+    """
+    # Create the folder
+    if not os.path.isdir(patient_folder):
+        os.makedirs(patient_folder)
+
+    # Write slices
+    study_uid, series_uid = generate_uid(), generate_uid()
+    sop_instance_uids = write_slices(patient_folder, scan, study_uid, series_uid)
+
+    # Write annotations
+    random = np.random.RandomState(seed)
+    root = make_annotations(scan, reader_count, study_uid, series_uid, sop_instance_uids, random)
+    ET.ElementTree(root).write(os.path.join(patient_folder, ANNOTATION_FILENAME),
+                               encoding='utf-8', xml_declaration=True)
+
+
+def write_slices(patient_folder, scan, study_uid, series_uid):
+    """
+    Write each slice of `scan` to `patient_folder` as a DICOM file of the given study and series.
+    Returns the SOP instance UID of each slice.
+    """
+    # Lazy-load pydicom
+    import dicom
+    import dicom.dataset
+
+    # Convert voxels to stored values
+    stored_values = np.clip(np.round(scan.voxels - RESCALE_INTERCEPT), -2 ** 15, 2 ** 15 - 1)
+    stored_values = stored_values.astype('<i2')
+
+    # SOP instance UIDs placeholder
+    sop_instance_uids = []
+
+    # For each slice
+    for z_index in range(scan.voxels.shape[-1]):
+        sop_instance_uid = generate_uid()
+        path = os.path.join(patient_folder, '%06d.dcm' % (z_index + 1))
+
+        # Describe the file
+        file_meta = getattr(dicom.dataset, 'FileMetaDataset', dicom.dataset.Dataset)()
+        file_meta.MediaStorageSOPClassUID = CT_IMAGE_STORAGE_UID
+        file_meta.MediaStorageSOPInstanceUID = sop_instance_uid
+        file_meta.TransferSyntaxUID = EXPLICIT_VR_LITTLE_ENDIAN_UID
+        header = dicom.dataset.FileDataset(path, {}, file_meta=file_meta, preamble=b'\0' * 128,
+                                           is_implicit_VR=False, is_little_endian=True)
+
+        # Identify the image
+        header.SOPClassUID = CT_IMAGE_STORAGE_UID
+        header.SOPInstanceUID = sop_instance_uid
+        header.StudyInstanceUID = study_uid
+        header.SeriesInstanceUID = series_uid
+        header.PatientID = scan.patient_id
+        header.Modality = 'CT'
+        header.InstanceNumber = z_index + 1
+
+        # Describe geometry (slices descend from the top of the scan)
+        header.PixelSpacing = [float(scan.unit_cell[0]), float(scan.unit_cell[1])]
+        header.SliceThickness = float(scan.unit_cell[2])
+        header.ImagePositionPatient = [0.0, 0.0, -z_index * float(scan.unit_cell[2])]
+        header.ImageOrientationPatient = [1.0, 0.0, 0.0, 0.0, 1.0, 0.0]
+
+        # Describe pixels
+        header.Rows, header.Columns = scan.voxels.shape[:2]
+        header.SamplesPerPixel = 1
+        header.PhotometricInterpretation = 'MONOCHROME2'
+        header.BitsAllocated = 16
+        header.BitsStored = 16
+        header.HighBit = 15
+        header.PixelRepresentation = 1
+        header.RescaleSlope = 1
+        header.RescaleIntercept = RESCALE_INTERCEPT
+        header.PixelData = np.ascontiguousarray(stored_values[..., z_index]).tobytes()
+
+        # Write the file
+        header.save_as(path)
+        sop_instance_uids.append(sop_instance_uid)
+
+    return sop_instance_uids
+
+
+def make_annotations(scan, reader_count, study_uid, series_uid, sop_instance_uids, random):
+    """
+    Create the root element of an LIDC annotation file in which each of `reader_count` readers
+    outlines every nodule of `scan` (slightly grown or shrunk at random).
+    """
+    # Create the message
+    namespace = '{' + lcat.loading.annotations.XMLNS['nih'] + '}'
+    ET.register_namespace('', lcat.loading.annotations.XMLNS['nih'])
+    root = ET.Element(namespace + 'LidcReadMessage')
+
+    # Describe the series
+    header = ET.SubElement(root, namespace + 'ResponseHeader')
+    ET.SubElement(header, namespace + 'StudyInstanceUID').text = study_uid
+    ET.SubElement(header, namespace + 'SeriesInstanceUid').text = series_uid
+
+    # For each reader
+    for reader in range(reader_count):
+        session = ET.SubElement(root, namespace + 'readingSession')
+        ET.SubElement(session, namespace + 'servicingRadiologistID').text = 'reader-%d' % reader
+
+        # Outline each nodule
+        for nodule in scan.nodules:
+            read = ET.SubElement(session, namespace + 'unblindedReadNodule')
+            ET.SubElement(read, namespace + 'noduleID').text = \
+                '%s (reader %d)' % (nodule.nodule_id, reader + 1)
+
+            # Rate characteristics
+            characteristics = ET.SubElement(read, namespace + 'characteristics')
+            for name, value in sorted(nodule.characteristics.items()):
+                ET.SubElement(characteristics, namespace + name).text = str(value)
+
+            # Outline each slice
+            origin, mask = get_reader_mask(nodule, scan.voxels.shape, random)
+            for z_offset in range(mask.shape[-1]):
+                for contour in get_contours(mask[..., z_offset]):
+                    add_roi(read, namespace, sop_instance_uids[origin[2] + z_offset],
+                            contour + origin[:2])
+
+    return root
+
+
+def get_reader_mask(nodule, shape, random):
+    """
+    Return the origin and mask of `nodule` as outlined by a reader, grown or shrunk in-plane by one
+    voxel at random and clipped to a volume of the given `shape`.
+    """
+    # Pad the mask (so that it can grow) and clip it to the volume
+    padded = np.pad(nodule.mask, [(1, 1), (1, 1), (0, 0)], mode='constant')
+    origin = [start - 1 for start in nodule.origin[:2]] + [nodule.origin[2]]
+    clip = tuple(slice(max(-start, 0), max(min(dim - start, size), 0))
+                 for start, dim, size in zip(origin, shape, padded.shape))
+    padded = padded[clip]
+    origin = [max(start, 0) for start in origin]
+
+    # Grow or shrink in-plane
+    structure = np.ones((3, 3, 1), dtype=bool)
+    change = random.randint(-1, 2)
+    if change > 0:
+        padded = scipy.ndimage.binary_dilation(padded, structure)
+    elif change < 0:
+        eroded = scipy.ndimage.binary_erosion(padded, structure)
+        padded = eroded if eroded.any() else padded
+
+    return np.asarray(origin), padded
+
+
+def get_contours(mask_slice):
+    """
+    Return the outline of each connected region of the 2D `mask_slice` as an (N, 2) array of
+    indices (the region voxels with a neighbor outside the region).
+    """
+    # Contours placeholder
+    contours = []
+
+    # For each region
+    labels, label_count = scipy.ndimage.label(mask_slice)
+    for label in range(1, label_count + 1):
+        region = labels == label
+        boundary = region & ~scipy.ndimage.binary_erosion(region)
+        contours.append(np.argwhere(boundary))
+
+    return contours
+
+
+def add_roi(read, namespace, sop_instance_uid, contour):
+    """
+    Add a region of interest outlined by the (N, 2) array of indices `contour` on the image
+    `sop_instance_uid` to the `read` element.
+    """
+    roi = ET.SubElement(read, namespace + 'roi')
+    ET.SubElement(roi, namespace + 'imageSOP_UID').text = sop_instance_uid
+    ET.SubElement(roi, namespace + 'inclusion').text = 'TRUE'
+    for x_position, y_position in contour:
+        edge_map = ET.SubElement(roi, namespace + 'edgeMap')
+        ET.SubElement(edge_map, namespace + 'xCoord').text = str(x_position)
+        ET.SubElement(edge_map, namespace + 'yCoord').text = str(y_position)
+
+
+def generate_uid():
+    """
+    Generate a new unique DICOM UID (derived from a random UUID).
+    """
+    return '2.25.%d' % uuid.uuid4().int
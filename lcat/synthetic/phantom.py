@@ -0,0 +1,264 @@
+"""
+Synthetic chest CT phantoms.
+
+A phantom is an elliptic cylinder of soft tissue (the body) surrounded by air, containing two
+ellipsoidal lungs, a trachea entering from the top slice which branches recursively into both
+lungs, and spherical or lobulated nodules placed within the lungs. All geometry is defined in
+physical units (millimeters), so phantoms of the same physical extent can be generated at any
+resolution and voxel spacing.
+"""
+from __future__ import division
+from collections import namedtuple
+
+import numpy as np
+
+import lcat.loading.annotations
+import lcat.loading.scans
+import lcat.util
+
+
+# Default phantom size (in voxels) and unit cell (in millimeters)
+DEFAULT_SHAPE = (128, 128, 96)
+DEFAULT_UNIT_CELL = (2.5, 2.5, 3.5)
+
+# Intensities (in Hounsfield units)
+AIR_INTENSITY = -1000
+LUNG_INTENSITY = -850
+TISSUE_INTENSITY = 40
+NODULE_INTENSITY = 20
+
+# Standard deviation of the noise added to the phantom (in Hounsfield units)
+NOISE_LEVEL = 20
+
+# Radius of the trachea (in millimeters) and fraction of the phantom height above the carina
+TRACHEA_RADIUS = 9.0
+TRACHEA_FRACTION = 0.3
+
+# Ratios between the radii and lengths of successive airway generations, and branching angle
+AIRWAY_RADIUS_RATIO = 0.7
+AIRWAY_LENGTH_RATIO = 0.75
+AIRWAY_BRANCH_ANGLE = np.radians(35)
+
+# Range of nodule radii (in millimeters)
+NODULE_RADIUS_RANGE = (3.0, 12.0)
+
+# Fraction of nodules which are lobulated rather than spherical, and number of lobes
+LOBULATED_FRACTION = 0.5
+LOBE_COUNT_RANGE = (3, 6)
+
+# LIDC characteristics assigned to each nodule (with their maximum rating)
+CHARACTERISTICS = {
+    'subtlety': 5,
+    'internalStructure': 4,
+    'calcification': 6,
+    'sphericity': 5,
+    'margin': 5,
+    'lobulation': 5,
+    'spiculation': 5,
+    'texture': 5,
+    'malignancy': 5,
+}
+
+# Lung datatype (center and semi-axes in millimeters)
+Lung = namedtuple('Lung', ['center', 'semi_axes'])
+
+
+def make_phantom(shape=DEFAULT_SHAPE, unit_cell=DEFAULT_UNIT_CELL, nodule_count=4,
+                 airway_generations=4, seed=0, patient_id='PHANTOM'):
+    """
+    Generate a synthetic chest CT `lcat.loading.scans.Scan` with the given `shape` (in voxels) and
+    `unit_cell` (in millimeters), containing `nodule_count` nodules and airways branching
+    `airway_generations` times below the trachea. The phantom is fully determined by `seed`.
+    """
+    # Seed random number generation
+    random = np.random.RandomState(seed)
+
+    # Start from air
+    voxels = np.full(shape, AIR_INTENSITY, dtype=np.float32)
+    extent = np.asarray(shape) * np.asarray(unit_cell, dtype=float)
+    x, y, z = get_coordinates(shape, unit_cell)
+
+    # Paint the body
+    body = ((x - extent[0] / 2) / (0.45 * extent[0])) ** 2 \
+        + ((y - extent[1] / 2) / (0.35 * extent[1])) ** 2 <= 1
+    voxels[np.broadcast_to(body, shape)] = TISSUE_INTENSITY
+    del body
+
+    # Paint the lungs
+    lungs = get_lungs(extent)
+    for lung in lungs:
+        paint_ellipsoid(voxels, lung.center, lung.semi_axes, unit_cell, LUNG_INTENSITY)
+
+    # Paint the trachea and the airway tree
+    carina = np.array([extent[0] / 2, extent[1] / 2, TRACHEA_FRACTION * extent[2]])
+    paint_segment(voxels, carina * [1, 1, 0], carina, TRACHEA_RADIUS, unit_cell, AIR_INTENSITY)
+    for lung in lungs:
+        direction = normalize(lung.center - carina)
+        length = np.linalg.norm(lung.center - carina) * 0.6
+        paint_airways(voxels, carina, direction, length, TRACHEA_RADIUS * AIRWAY_RADIUS_RATIO,
+                      airway_generations, unit_cell, random)
+
+    # Paint the nodules
+    nodules = []
+    for index in range(nodule_count):
+        nodule = make_nodule('Nodule %03d' % (index + 1), lungs, shape, unit_cell, random)
+        region = voxels[tuple(slice(start, start + dim)
+                              for start, dim in zip(nodule.origin, nodule.mask.shape))]
+        region[nodule.mask] = NODULE_INTENSITY
+        nodules.append(nodule)
+
+    # Add noise
+    voxels += random.normal(0, NOISE_LEVEL, shape).astype(np.float32)
+
+    return lcat.loading.scans.Scan(patient_id, voxels, nodules, tuple(float(step)
+                                                                      for step in unit_cell))
+
+
+def get_coordinates(shape, unit_cell, origin=(0, 0, 0)):
+    """
+    Return open grids of the physical coordinates of the centers of the voxels of a region with the
+    given `shape` placed at index `origin`.
+    """
+    return [((np.arange(dim) + start + 0.5) * step).reshape([-1 if axis == index else 1
+                                                             for axis in range(len(shape))])
+            for index, (dim, start, step) in enumerate(zip(shape, origin, unit_cell))]
+
+
+def get_region(low, high, shape, unit_cell):
+    """
+    Return the index origin and shape of the region of a volume of the given `shape` covering the
+    physical box from `low` to `high` (clipped to the volume).
+    """
+    start = np.clip(np.floor(np.asarray(low) / unit_cell).astype(int), 0, shape)
+    stop = np.clip(np.ceil(np.asarray(high) / unit_cell).astype(int), 0, shape)
+
+    return start, np.maximum(stop - start, 0)
+
+
+def paint_ellipsoid(voxels, center, semi_axes, unit_cell, value):
+    """
+    Set the voxels within the ellipsoid with the given `center` and `semi_axes` to `value`.
+    """
+    # Restrict to the bounding box
+    start, size = get_region(np.subtract(center, semi_axes), np.add(center, semi_axes),
+                             voxels.shape, unit_cell)
+    coordinates = get_coordinates(size, unit_cell, start)
+
+    # Paint the ellipsoid
+    inside = sum(((coordinate - position) / semi_axis) ** 2
+                 for coordinate, position, semi_axis in zip(coordinates, center, semi_axes)) <= 1
+    voxels[tuple(slice(low, low + dim) for low, dim in zip(start, size))][inside] = value
+
+
+def paint_segment(voxels, start, end, radius, unit_cell, value, within=None):
+    """
+    Set the voxels within `radius` of the line segment from `start` to `end` to `value`. If
+    `within` is given, only voxels currently equal to `within` are painted.
+    """
+    # Restrict to the bounding box
+    origin, size = get_region(np.minimum(start, end) - radius, np.maximum(start, end) + radius,
+                              voxels.shape, unit_cell)
+    coordinates = get_coordinates(size, unit_cell, origin)
+    region = voxels[tuple(slice(low, low + dim) for low, dim in zip(origin, size))]
+
+    # Project voxels onto the segment
+    axis = np.subtract(end, start)
+    offsets = [coordinate - position for coordinate, position in zip(coordinates, start)]
+    fraction = np.clip(sum(offset * step for offset, step in zip(offsets, axis))
+                       / max(np.dot(axis, axis), 1e-12), 0, 1)
+
+    # Paint voxels near the segment
+    inside = sum((offset - fraction * step) ** 2 for offset, step in zip(offsets, axis)) \
+        <= radius ** 2
+    if within is not None:
+        inside &= region == within
+    region[inside] = value
+
+
+def paint_airways(voxels, start, direction, length, radius, generations, unit_cell, random,
+                  within=None):
+    """
+    Paint an airway of the given `radius` and `length` from `start` along `direction`, followed by
+    `generations` further generations of pairs of branches. Branches are confined to the lungs.
+    """
+    # Stop once airways become thinner than a voxel
+    if generations < 0 or radius < min(unit_cell) / 2:
+        return
+
+    # Paint the airway
+    end = start + direction * length
+    paint_segment(voxels, start, end, radius, unit_cell, AIR_INTENSITY, within)
+
+    # Branch in a random plane containing the airway
+    normal = normalize(np.cross(direction, normalize(random.normal(size=3))))
+    for sign in (-1, 1):
+        branch = np.cos(AIRWAY_BRANCH_ANGLE) * direction \
+            + sign * np.sin(AIRWAY_BRANCH_ANGLE) * normal
+        paint_airways(voxels, end, normalize(branch), length * AIRWAY_LENGTH_RATIO,
+                      radius * AIRWAY_RADIUS_RATIO, generations - 1, unit_cell, random,
+                      within=LUNG_INTENSITY)
+
+
+def get_lungs(extent):
+    """
+    Return the right and left `Lung`s of a phantom with the given physical `extent`.
+    """
+    semi_axes = np.array([0.16, 0.25, 0.36]) * extent
+    return [Lung(np.array([(0.5 + side * 0.2) * extent[0], 0.5 * extent[1], 0.6 * extent[2]]),
+                 semi_axes)
+            for side in (-1, 1)]
+
+
+def make_nodule(nodule_id, lungs, shape, unit_cell, random):
+    """
+    Create a randomly placed spherical or lobulated `lcat.loading.annotations.Nodule` within one of
+    the `lungs`, with random LIDC characteristics.
+    """
+    # Choose a size and shape
+    radius = random.uniform(*NODULE_RADIUS_RANGE)
+    lobulated = random.uniform() < LOBULATED_FRACTION
+    spheres = [(np.zeros(3), radius)]
+    if lobulated:
+        for _ in range(random.randint(LOBE_COUNT_RANGE[0], LOBE_COUNT_RANGE[1] + 1)):
+            spheres.append((normalize(random.normal(size=3)) * radius * 0.8,
+                            radius * random.uniform(0.4, 0.6)))
+
+    # Place the nodule within a lung (away from its boundary)
+    lung = lungs[random.randint(len(lungs))]
+    center = lung.center + normalize(random.normal(size=3)) * random.uniform(0, 0.6) \
+        * np.maximum(lung.semi_axes - 1.5 * radius, 0)
+
+    # Rasterize the nodule within its bounding box
+    reach = radius * 1.5
+    origin, size = get_region(center - reach, center + reach, shape, unit_cell)
+    coordinates = get_coordinates(size, unit_cell, origin)
+    mask = np.zeros(size, dtype=bool)
+    for offset, sphere_radius in spheres:
+        mask |= sum((coordinate - position) ** 2
+                    for coordinate, position in zip(coordinates, center + offset)) \
+            <= sphere_radius ** 2
+
+    # Keep at least the voxel containing the center (for nodules smaller than a voxel)
+    if not mask.any():
+        center_index = np.clip(np.floor(center / unit_cell).astype(int) - origin, 0, size - 1)
+        mask[tuple(center_index)] = True
+
+    # Crop to the nodule
+    local_origin, mask = lcat.util.compress_nodule_mask(mask)
+    origin = [int(start + local_start) for start, local_start in zip(origin, local_origin)]
+
+    # Rate characteristics
+    characteristics = dict((name, int(random.randint(1, maximum + 1)))
+                           for name, maximum in sorted(CHARACTERISTICS.items()))
+    if lobulated:
+        characteristics['lobulation'] = max(characteristics['lobulation'], 3)
+
+    return lcat.loading.annotations.Nodule(nodule_id, characteristics, origin, mask)
+
+
+def normalize(vector):
+    """
+    Return `vector` scaled to unit length.
+    """
+    vector = np.asarray(vector, dtype=float)
+    return vector / np.linalg.norm(vector)
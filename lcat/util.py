@@ -1,6 +1,7 @@
 """
 Utility functions for the lcat toolkit.
 """
+from collections import namedtuple
 import itertools
 import os
 
@@ -8,6 +9,11 @@ import matplotlib.pyplot as plt
 import numpy as np
 import scipy
 
+import lcat.masks
+
+
+# Nodule view datatype (see `get_nodule_view`)
+NoduleView = namedtuple('NoduleView', ['mask', 'voxels', 'origin', 'slicer'])
 
 
 def plot_slices(voxels, rows=6, columns=6, cmap=None):
@@ -73,6 +79,10 @@ def get_bounding_box(arr):
 
     Inspired by http://stackoverflow.com/questions/31400769/bounding-box-of-numpy-array
     """
+    # Use the packed implementation for packed masks
+    if isinstance(arr, lcat.masks.PackedMask):
+        return arr.get_bounding_box()
+
     # Boundaries placeholder
     boundaries = []
 
@@ -105,6 +115,59 @@ def crop_to_box(arr, box):
     return arr[slicer]
 
 
+def get_window(arr, origin, start, end):
+    """
+    Given an array `arr` placed at index `origin` within a larger volume, return the window of that
+    volume between the indices `start` (inclusive) and `end` (exclusive). Parts of the window not
+    covered by `arr` are filled with zeros.
+    """
+    # Create window placeholder
+    window = np.zeros([window_end - window_start for window_start, window_end in zip(start, end)],
+                      dtype=arr.dtype)
+
+    # Determine overlap in volume coordinates
+    overlap_start = [max(window_start, arr_start) for window_start, arr_start in zip(start, origin)]
+    overlap_end = [min(window_end, arr_start + dim)
+                   for window_end, arr_start, dim in zip(end, origin, arr.shape)]
+
+    # Stop if there is no overlap
+    if any(overlap_stop <= overlap_begin
+           for overlap_begin, overlap_stop in zip(overlap_start, overlap_end)):
+        return window
+
+    # Copy overlapping region
+    window_slicer = tuple(slice(overlap_begin - window_start, overlap_stop - window_start)
+                          for overlap_begin, overlap_stop, window_start
+                          in zip(overlap_start, overlap_end, start))
+    arr_slicer = tuple(slice(overlap_begin - arr_start, overlap_stop - arr_start)
+                       for overlap_begin, overlap_stop, arr_start
+                       in zip(overlap_start, overlap_end, origin))
+    window[window_slicer] = arr[arr_slicer]
+
+    return window
+
+
+def get_nodule_view(nodule, voxels):
+    """
+    Given a nodule and the `voxels` of its scan, return a `NoduleView` restricted to the nodule's
+    bounding box (clipped to the scan). The view contains the nodule `mask`, the matching sub-block
+    of `voxels`, the index `origin` of the sub-block in the scan, and a `slicer` which selects the
+    same sub-block from any full-volume map, so that values inside the nodule can be read using
+    `full_map[view.slicer][view.mask]`.
+    """
+    # Clip nodule extents to the scan
+    starts = [max(start, 0) for start in nodule.origin]
+    ends = [min(start + dim, scan_dim)
+            for start, dim, scan_dim in zip(nodule.origin, nodule.mask.shape, voxels.shape)]
+
+    # Create slicers for the scan and the nodule mask
+    slicer = tuple(slice(start, end) for start, end in zip(starts, ends))
+    mask_slicer = tuple(slice(start - nodule_start, end - nodule_start)
+                        for start, end, nodule_start in zip(starts, ends, nodule.origin))
+
+    return NoduleView(nodule.mask[mask_slicer], voxels[slicer], starts, slicer)
+
+
 def get_full_nodule_mask(nodule, scan_shape):
     # Create full placeholder
     mask = np.zeros(scan_shape, dtype=bool)
@@ -0,0 +1,445 @@
+#!/usr/bin/env python
+"""
+Benchmark the computational and loading stages of the toolkit on synthetic data.
+"""
+from __future__ import division, print_function
+import argparse
+from collections import namedtuple
+import gc
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+import xml.etree.ElementTree as ET
+
+import numpy as np
+import scipy
+import skimage
+from tqdm import tqdm
+
+import lcat
+import lcat.cache
+import lcat.featurization
+import lcat.instrumentation
+import lcat.loading.annotations
+import lcat.loading.catalog
+import lcat.loading.images
+import lcat.loading.scans
+import lcat.synthetic
+
+
+DESCRIPTION = "Benchmark lcat-toolkit stages on synthetic data, writing results as JSON."
+
+# Default phantom sizes (in voxels)
+DEFAULT_SIZES = ['64x64x48', '128x128x96']
+
+# Default size of the phantoms of generated I/O benchmark datasets (in voxels)
+DEFAULT_IO_SIZE = '256x256x128'
+
+# Measurement datatype
+# `wall_times` and `cpu_times` hold the duration (in seconds) of each repetition, `peak_memory` the
+# peak memory allocated while running the stage once more under tracemalloc (in bytes, None if
+# tracemalloc isn't available) and `max_rss` the peak resident set size of the benchmark process
+# after the stage (in bytes, None if unavailable).
+Measurement = namedtuple('Measurement', ['wall_times', 'cpu_times', 'peak_memory', 'max_rss'])
+
+
+def benchmark_compute(destination_file, sizes, unit_cell, repeat=3, featurizer_names=None,
+                      seed=0):
+    """
+    Benchmark the computational stages on phantoms of each of the given `sizes` (with the given
+    `unit_cell`), repeating each measurement `repeat` times, and write the results to
+    `destination_file` as JSON.
+    """
+    # Disable persistent caching (cached results would be measured instead of computations)
+    os.environ.pop(lcat.cache.CACHE_FOLDER_VARIABLE, None)
+
+    # Measurements and accuracy placeholders
+    measurements = []
+    accuracy = []
+
+    # For each size
+    for shape in sizes:
+        tqdm.write("Generating %s phantom..." % 'x'.join(str(dim) for dim in shape))
+        scan = lcat.synthetic.make_phantom(shape, unit_cell, seed=seed)
+
+        # Measure each stage
+        stages = get_compute_stages(scan, featurizer_names)
+        for stage_name, stage in tqdm(stages, desc="Benchmarking"):
+            measurement = measure(stage, repeat)
+            record = {'stage': stage_name, 'shape': list(shape), 'unit_cell': list(unit_cell)}
+            record.update(measurement._asdict())
+            measurements.append(record)
+
+        # Compare airway graph distances against exact tracheal distances
+        record = {'shape': list(shape), 'unit_cell': list(unit_cell)}
+        record.update(compare_airway_distances(scan))
+        accuracy.append(record)
+
+    # Write results
+    results = {
+        'benchmark': 'compute',
+        'environment': get_environment(),
+        'settings': {'sizes': [list(shape) for shape in sizes], 'unit_cell': list(unit_cell),
+                     'repeat': repeat, 'seed': seed},
+        'measurements': measurements,
+        'accuracy': accuracy,
+    }
+    with open(destination_file, 'w') as destination:
+        json.dump(results, destination, indent=2, sort_keys=True)
+
+
+def benchmark_io(destination_file, data_folder=None, patient_count=4, shape=None, unit_cell=None,
+                 nodule_count=4, reader_count=4, repeat=3, seed=0):
+    """
+    Benchmark the loading stages (patient discovery, header reading, slice loading and annotation
+    parsing) on all patients of the LIDC-IDRI dataset in `data_folder`, repeating each measurement
+    `repeat` times, and write the results to `destination_file` as JSON. If `data_folder` isn't
+    given, a temporary synthetic dataset of `patient_count` patients of the given `shape` and
+    `unit_cell` (see `lcat.synthetic.write_dataset`) is generated and removed afterwards. Files are
+    read from the page cache after their first read, so results reflect parsing rather than disk
+    throughput.
+    """
+    # Generate a dataset if necessary
+    temporary_folder = None
+    if data_folder is None:
+        tqdm.write("Generating dataset of %d patients..." % patient_count)
+        temporary_folder = data_folder = tempfile.mkdtemp(prefix='lcat-benchmark-')
+        lcat.synthetic.write_dataset(data_folder, patient_count,
+                                     shape or parse_size(DEFAULT_IO_SIZE),
+                                     unit_cell or lcat.synthetic.phantom.DEFAULT_UNIT_CELL,
+                                     nodule_count, reader_count, seed)
+
+    try:
+        # Describe the dataset
+        patient_paths = sorted(lcat.loading.catalog.generate_patient_paths(data_folder))
+        sizes = get_dataset_sizes(patient_paths)
+
+        # Measure each stage
+        measurements = []
+        for stage_name, stage, units in tqdm(get_io_stages(patient_paths), desc="Benchmarking"):
+            measurement = measure(stage, repeat)
+            record = {'stage': stage_name, 'patient_count': len(patient_paths)}
+            record.update(measurement._asdict())
+            record.update(get_rates(measurement, dict((unit, sizes[unit]) for unit in units)))
+            measurements.append(record)
+    finally:
+        # Remove generated datasets
+        if temporary_folder is not None:
+            shutil.rmtree(temporary_folder)
+
+    # Write results
+    results = {
+        'benchmark': 'io',
+        'environment': get_environment(),
+        'settings': {'data_folder': None if temporary_folder else data_folder,
+                     'patient_count': len(patient_paths), 'repeat': repeat},
+        'dataset': sizes,
+        'measurements': measurements,
+    }
+    with open(destination_file, 'w') as destination:
+        json.dump(results, destination, indent=2, sort_keys=True)
+
+
+def get_io_stages(patient_paths):
+    """
+    Return a list of stage names, functions (without arguments) running each benchmarked loading
+    stage on all patients in `patient_paths`, and the units (see `get_dataset_sizes`) processed by
+    each stage.
+    """
+    # Precompute annotation inputs
+    images = dict((patient_id, lcat.loading.images.load_folder(path))
+                  for patient_id, path in patient_paths)
+
+    def discover_patients():
+        """
+        List the patients of the data folders.
+        """
+        for folder in set(os.path.dirname(path) for _, path in patient_paths):
+            list(lcat.loading.catalog.generate_patient_paths(folder))
+
+    def read_headers():
+        """
+        Read the headers of all slices.
+        """
+        for _, path in patient_paths:
+            lcat.loading.images.read_series_headers(path)
+
+    def load_images():
+        """
+        Load the slices of all patients.
+        """
+        for _, path in patient_paths:
+            lcat.loading.images.load_folder(path)
+
+    def load_annotations():
+        """
+        Load the annotations of all patients.
+        """
+        for patient_id, path in patient_paths:
+            _, voxels, _, sop_instance_uids = images[patient_id]
+            lcat.loading.annotations.load_radiologist_annotations(path, voxels.shape,
+                                                                  sop_instance_uids)
+
+    return [
+        ('generate_patient_paths', discover_patients, ['patients']),
+        ('read_series_headers', read_headers, ['files']),
+        ('load_folder', load_images, ['files', 'megabytes']),
+        ('load_radiologist_annotations', load_annotations, ['reads', 'rois']),
+    ]
+
+
+def get_dataset_sizes(patient_paths):
+    """
+    Count the patients, DICOM files (and their size in megabytes), nodule reads and regions of
+    interest of the patients in `patient_paths`.
+    """
+    sizes = {'patients': len(patient_paths), 'files': 0, 'megabytes': 0.0, 'reads': 0, 'rois': 0}
+
+    # For each file
+    for _, path in patient_paths:
+        for filename in os.listdir(path):
+            filepath = os.path.join(path, filename)
+
+            # Count slices
+            if filename.endswith('.dcm'):
+                sizes['files'] += 1
+                sizes['megabytes'] += os.path.getsize(filepath) / 1024 ** 2
+
+            # Count reads and regions of interest
+            elif filename.endswith('.xml'):
+                root = ET.parse(filepath).getroot()
+                xmlns = lcat.loading.annotations.XMLNS
+                sizes['reads'] += len(root.findall(
+                    './/nih:readingSession//nih:unblindedReadNodule', xmlns))
+                sizes['rois'] += len(root.findall('.//nih:roi', xmlns))
+
+    return sizes
+
+
+def get_rates(measurement, sizes):
+    """
+    Derive throughputs (`<unit>_per_second`, from the median wall time of `measurement`) and
+    durations per unit (`seconds_per_<unit>`) for each unit count in `sizes`.
+    """
+    rates = {}
+    wall_time = float(np.median(measurement.wall_times)) if measurement.wall_times else None
+    for unit, count in sizes.items():
+        rates[unit + '_per_second'] = count / wall_time if wall_time and count else None
+        rates['seconds_per_' + unit[:-1]] = wall_time / count if wall_time and count else None
+
+    return rates
+
+
+def get_compute_stages(scan, featurizer_names=None):
+    """
+    Return a list of stage names and functions (without arguments) running each benchmarked stage
+    on `scan`: resampling, segmentation, tracheal distances, airway graph construction and queries
+    and each featurizer (or only those in `featurizer_names`). Stages are given the intermediate
+    products they require precomputed.
+    """
+    # Precompute inputs
+    lung_segmentation = lcat.get_lung_segmentation(scan)
+    airway_graph = lcat.get_airway_graph(scan, lung_segmentation)
+
+    # Core stages
+    stages = [
+        ('cubify_scan', lambda: lcat.loading.scans.cubify_scan(scan)),
+        ('get_lung_segmentation', lambda: lcat.get_lung_segmentation(scan)),
+        ('get_body_segmentation', lambda: lcat.get_body_segmentation(scan)),
+        ('get_tracheal_distances', lambda: lcat.get_tracheal_distances(scan, lung_segmentation)),
+        ('get_nodule_tracheal_distances',
+         lambda: lcat.get_nodule_tracheal_distances(scan, lung_segmentation)),
+        ('get_airway_graph', lambda: lcat.get_airway_graph(scan, lung_segmentation)),
+        ('get_nodule_airway_distances',
+         lambda: [lcat.get_nodule_airway_distances(airway_graph, nodule)
+                  for nodule in scan.nodules]),
+    ]
+
+    # Featurizer stages
+    registry = lcat.featurization.registry
+    for featurizer_name in registry.get_featurizer_names(featurizer_names):
+        # Compute required products
+        requirements = registry.FEATURIZER_REQUIREMENTS[featurizer_name]
+        store = registry.ProductStore(scan, [featurizer_name])
+        products = dict((requirement, store.get(requirement)) for requirement in requirements)
+
+        # Bind the featurizer (binding loop variables through default arguments)
+        featurizer = registry.FEATURIZERS[featurizer_name]
+        stages.append(('featurizer:' + featurizer_name,
+                       lambda featurizer=featurizer, products=products: featurizer(scan,
+                                                                                   **products)))
+
+    return stages
+
+
+def measure(function, repeat):
+    """
+    Run `function` `repeat` times, measuring wall and CPU time, then once more measuring peak
+    memory. Returns a `Measurement`.
+    """
+    # Time placeholders
+    wall_times = []
+    cpu_times = []
+
+    # Time each repetition
+    for _ in range(repeat):
+        gc.collect()
+        wall_start = lcat.instrumentation.get_wall_time()
+        cpu_start = lcat.instrumentation.get_cpu_time()
+        function()
+        cpu_times.append(lcat.instrumentation.get_cpu_time() - cpu_start)
+        wall_times.append(lcat.instrumentation.get_wall_time() - wall_start)
+
+    # Measure peak memory
+    peak_memory = None
+    try:
+        import tracemalloc
+    except ImportError:
+        tracemalloc = None
+    if tracemalloc is not None:
+        gc.collect()
+        tracemalloc.start()
+        try:
+            function()
+            peak_memory = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    return Measurement(wall_times, cpu_times, peak_memory, lcat.instrumentation.get_max_rss())
+
+
+def compare_airway_distances(scan):
+    """
+    Compare the airway graph distances (see `lcat.analysis.airway_graph`) of the nodule voxels of
+    `scan` against the exact tracheal distances. Returns a dictionary of error statistics (in
+    physical units), where relative errors are signed (positive if the graph overestimates).
+    """
+    # Compute both distances
+    lung_segmentation = lcat.get_lung_segmentation(scan)
+    exact = lcat.get_nodule_tracheal_distances(scan, lung_segmentation)
+    airway_graph = lcat.get_airway_graph(scan, lung_segmentation)
+    approximate = [lcat.get_nodule_airway_distances(airway_graph, nodule)
+                   for nodule in scan.nodules]
+
+    # Compare nodule voxels
+    exact = np.concatenate([np.zeros(0)] + exact).astype(np.float64)
+    errors = np.concatenate([np.zeros(0)] + approximate) - exact
+    positive = exact > 0
+    relative_errors = errors[positive] / exact[positive]
+
+    return {
+        'voxel_count': int(exact.size),
+        'mean_absolute_error': float(np.mean(np.abs(errors))) if errors.size else None,
+        'max_absolute_error': float(np.max(np.abs(errors))) if errors.size else None,
+        'mean_relative_error': (float(np.mean(relative_errors)) if relative_errors.size
+                                else None),
+        'min_relative_error': float(np.min(relative_errors)) if relative_errors.size else None,
+        'max_relative_error': float(np.max(relative_errors)) if relative_errors.size else None,
+    }
+
+
+def get_environment():
+    """
+    Describe the environment of the benchmark run.
+    """
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count() if hasattr(os, 'cpu_count') else None,
+        'numpy': np.__version__,
+        'scipy': scipy.__version__,
+        'scikit-image': skimage.__version__,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def parse_size(size):
+    """
+    Parse a phantom size of the form `XxYxZ` (in voxels).
+    """
+    try:
+        shape = tuple(int(dim) for dim in size.lower().split('x'))
+    except ValueError:
+        shape = ()
+    if len(shape) != 3 or min(shape) <= 0:
+        raise argparse.ArgumentTypeError("Invalid size '%s' (expected XxYxZ)." % size)
+
+    return shape
+
+
+def main():
+    """
+    Launch the benchmark suite.
+    """
+    # Set up arguments
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    # Compute benchmark arguments
+    compute_parser = subparsers.add_parser(
+        'compute', help="Time and memory-profile resampling, segmentation, tracheal distances, "
+                        "airway graphs and featurizers on in-memory phantoms, and compare airway "
+                        "graph distances against exact tracheal distances.")
+    compute_parser.add_argument('destination_file', metavar="destination-file",
+                                help="Destination JSON file for benchmark results.")
+    compute_parser.add_argument('--sizes', metavar="XxYxZ", nargs='+', type=parse_size,
+                                default=[parse_size(size) for size in DEFAULT_SIZES],
+                                help="Phantom sizes in voxels (defaults to %s)."
+                                     % ' '.join(DEFAULT_SIZES))
+    compute_parser.add_argument('--unit-cell', metavar="mm", nargs=3, type=float,
+                                default=list(lcat.synthetic.phantom.DEFAULT_UNIT_CELL),
+                                help="Phantom voxel spacing in millimeters.")
+    compute_parser.add_argument('--repeat', metavar="count", type=int, default=3,
+                                help="Number of timed repetitions of each stage.")
+    compute_parser.add_argument('--featurizers', metavar="featurizer", nargs='+', default=None,
+                                choices=sorted(lcat.featurization.registry.FEATURIZERS),
+                                help="Featurizers to benchmark (defaults to all featurizers).")
+    compute_parser.add_argument('--seed', metavar="seed", type=int, default=0,
+                                help="Random seed of the phantoms.")
+
+    # I/O benchmark arguments
+    io_parser = subparsers.add_parser(
+        'io', help="Time patient discovery, header reading, slice loading and annotation parsing "
+                   "on an LIDC-IDRI dataset (synthetic by default).")
+    io_parser.add_argument('destination_file', metavar="destination-file",
+                           help="Destination JSON file for benchmark results.")
+    io_parser.add_argument('--data-folder', metavar="scan-folder", default=None,
+                           help="Folder containing LIDC-IDRI data (by default, a temporary "
+                                "synthetic dataset is generated).")
+    io_parser.add_argument('--patients', metavar="count", type=int, default=4,
+                           help="Number of patients of the synthetic dataset.")
+    io_parser.add_argument('--size', metavar="XxYxZ", type=parse_size,
+                           default=parse_size(DEFAULT_IO_SIZE),
+                           help="Size of the synthetic scans in voxels (the last axis being the "
+                                "slice count, defaults to %s)." % DEFAULT_IO_SIZE)
+    io_parser.add_argument('--unit-cell', metavar="mm", nargs=3, type=float,
+                           default=list(lcat.synthetic.phantom.DEFAULT_UNIT_CELL),
+                           help="Voxel spacing of the synthetic scans in millimeters.")
+    io_parser.add_argument('--nodules', metavar="count", type=int, default=4,
+                           help="Number of nodules of each synthetic scan.")
+    io_parser.add_argument('--readers', metavar="count", type=int, default=4,
+                           help="Number of readers annotating each synthetic scan.")
+    io_parser.add_argument('--repeat', metavar="count", type=int, default=3,
+                           help="Number of timed repetitions of each stage.")
+    io_parser.add_argument('--seed', metavar="seed", type=int, default=0,
+                           help="Random seed of the synthetic dataset.")
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    # Run benchmark
+    if args.benchmark == 'compute':
+        benchmark_compute(args.destination_file, args.sizes, tuple(args.unit_cell), args.repeat,
+                          args.featurizers, args.seed)
+    elif args.benchmark == 'io':
+        benchmark_io(args.destination_file, args.data_folder, args.patients, args.size,
+                     tuple(args.unit_cell), args.nodules, args.readers, args.repeat, args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,90 +4,531 @@ Featurize tumor tracheal distance.
 """
 from __future__ import print_function
 import argparse
+from collections import namedtuple
+import csv
 import itertools
+import json
+import multiprocessing
 import os
-import re
+import shutil
+import tempfile
+import threading
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
 import lcat
+import lcat.cache
 import lcat.featurization
+import lcat.instrumentation
+import lcat.loading.catalog
 
 
 DESCRIPTION = "Featurize tumor tracheal distance."
 
-PATIENT_FOLDER_RE = re.compile('LIDC-IDRI-(.+)')
 
+# Featurization options datatype (see `featurize_patient`)
+FeaturizationOptions = namedtuple('FeaturizationOptions', ['featurizer_names', 'concurrency',
+                                                           'processes', 'cubify'])
+
+# Default featurization options
+DEFAULT_OPTIONS = FeaturizationOptions(None, 1, False, False)
+
+# Patient task datatype (`memory` is the estimated memory required to featurize the scan)
+PatientTask = namedtuple('PatientTask', ['patient_id', 'path', 'memory'])
+
+# Estimated memory required to featurize a scan per byte of scan files (voxels, segmentations and
+# intermediate products)
+MEMORY_PER_SCAN_BYTE = 8
+
+# Additional memory factor for cubified scans
+CUBIFY_MEMORY_FACTOR = 3
+
+# Estimated memory required to featurize a scan per voxel (used with a catalog)
+MEMORY_PER_VOXEL = 16
+
+# Interval (in seconds) at which worker processes are checked for failures
+POOL_POLL_INTERVAL = 1
 
-def execute(data_folder, destination_file):
+# Suffix of the folder holding the featurization of each patient next to the destination file
+PARTS_FOLDER_SUFFIX = '.parts'
+
+# Name of the file recording completed patients within the parts folder
+MANIFEST_FILENAME = 'manifest.jsonl'
+
+# Name of the file recording the featurization settings within the parts folder
+SETTINGS_FILENAME = 'settings.json'
+
+
+def execute(data_folder, destination_file, options=DEFAULT_OPTIONS, workers=1,
+            memory_budget=None, prefetch=0, catalog_path=None):
     """
     Featurize tumor tracheal distance for all patients in `data_folder`, and write featurization to
-    `destination_file`.
-    """
-    # Create featurizations placeholder
-    featurizations = []
+    `destination_file`. `options` is a `FeaturizationOptions` controlling the featurization of each
+    scan (see `featurize_patient`).
+
+    If `workers` is greater than one, patients are featurized in a pool of `workers` processes,
+    starting with the largest scans. If `memory_budget` (in bytes per worker) is given, scans are
+    only started while the estimated memory use of all running scans stays within the combined
+    budget of all workers. Otherwise, if `prefetch` is positive, up to `prefetch` scans are loaded
+    in the background while the current scan is featurized (limited by `memory_budget`, see
+    `prefetch_scans`). Rows are always written in order of patient ID.
+
+    The featurization of each patient is written to a separate file in a parts folder next to
+    `destination_file` as soon as it completes, and recorded in a manifest. If the run is
+    interrupted, a new run with the same settings skips all completed patients. The parts are
+    merged into `destination_file` at the end of the run.
 
+    If `catalog_path` is given, the catalog of `data_folder` at `catalog_path` is brought up to date
+    (see `lcat.loading.catalog.update_catalog`) and used to list patients and to estimate the
+    memory required by each scan from its dimensions.
+    """
     # List all patient paths
-    patient_paths = list(generate_patient_paths(data_folder))
+    estimates = None
+    if catalog_path is not None:
+        tqdm.write("Updating catalog...")
+        entries = lcat.loading.catalog.update_catalog(data_folder, catalog_path)
+        patient_paths = [(entry.patient_id, entry.path) for entry in entries]
+        estimates = get_catalog_estimates(entries, options.cubify)
+    else:
+        patient_paths = sorted(lcat.loading.catalog.generate_patient_paths(data_folder))
+
+    # Skip completed patients
+    parts_folder = destination_file + PARTS_FOLDER_SUFFIX
+    completed = prepare_parts_folder(parts_folder, options)
+    remaining_paths = [(patient_id, path) for patient_id, path in patient_paths
+                       if patient_id not in completed]
+    if completed:
+        tqdm.write("Resuming featurization, %d patients already completed..." % len(completed))
+
+    # Featurize patients
+    if workers > 1:
+        # Featurizer processes can't be started from (daemonic) worker processes
+        if options.processes:
+            tqdm.write("Featurizer processes aren't supported with multiple workers, using "
+                       "threads instead...")
+            options = options._replace(processes=False)
+
+        tasks = get_patient_tasks(remaining_paths, options.cubify, estimates)
+        total_budget = None if memory_budget is None else workers * memory_budget
+        results = featurize_in_pool(tasks, options, workers, total_budget)
+    elif prefetch > 0:
+        scans = prefetch_scans(remaining_paths, options.cubify, prefetch, memory_budget,
+                               estimates)
+        results = (featurize_patient_scan(patient_id, scan, options) for patient_id, scan in scans)
+    else:
+        results = (featurize_patient(patient_id, path, options)
+                   for patient_id, path in remaining_paths)
+
+    # Write each featurization as it completes
+    for patient_id, featurization in tqdm(results, total=len(remaining_paths),
+                                          desc="Featurizing"):
+        if featurization is not None:
+            write_part(parts_folder, patient_id, featurization)
+
+    # Combine featurizations (in order of patient ID)
+    merge_parts(parts_folder, [patient_id for patient_id, _ in patient_paths], destination_file)
+
 
-    # For each patient in the folder
-    for patient_id, path in tqdm(patient_paths, desc="Featurizing"):
-        # Update progress bar
+def featurize_patient(patient_id, path, options):
+    """
+    Load and featurize the scan of the patient `patient_id` at `path`. Returns the patient ID and
+    the featurization of the scan, indexed by patient_id and nodule_id. The scan is resampled to
+    cubic voxels if `options.cubify` is true, and up to `options.concurrency` of the featurizers
+    `options.featurizer_names` are run at once (using processes if `options.processes` is true).
+    Returns None as the featurization if the scan can't be featurized.
+    """
+    # Load scan
+    scan = load_patient_scan(patient_id, path, options.cubify)
+
+    return featurize_patient_scan(patient_id, scan, options)
+
+
+def load_patient_scan(patient_id, path, cubify):
+    """
+    Load the scan of the patient `patient_id` at `path` (resampled to cubic voxels if `cubify` is
+    true). Returns None if the scan can't be loaded.
+    """
+    try:
         tqdm.write("Loading scan for patient %s..." % patient_id)
+        with lcat.instrumentation.tagged(patient_id=patient_id):
+            return lcat.load_scan(path, cubify=cubify)
+    except Exception:
+        tqdm.write("Error loading scan for patient %s, skipping..." % patient_id)
+        return None
 
-        # Load scan
-        scan = lcat.load_scan(path, cubify=True)
 
-        tqdm.write("Featurizing scan...")
+def featurize_patient_scan(patient_id, scan, options):
+    """
+    Featurize the loaded `scan` of the patient `patient_id` (see `featurize_patient`). `scan` may
+    be None if it couldn't be loaded. Returns the patient ID and the featurization (or None).
+    """
+    # Skip scans which couldn't be loaded
+    if scan is None:
+        return patient_id, None
 
+    try:
         # Featurize scan
-        featurization = lcat.featurization.featurize_scan(scan)
+        tqdm.write("Featurizing scan for patient %s..." % patient_id)
+        with lcat.instrumentation.tagged(patient_id=patient_id), \
+                lcat.instrumentation.stage('featurize_scan'):
+            featurization = lcat.featurization.featurize_scan(
+                scan, options.featurizer_names, concurrency=options.concurrency,
+                processes=options.processes)
+    except Exception:
+        tqdm.write("Error featurizing patient %s, skipping..." % patient_id)
+        return patient_id, None
 
-        if len(featurization) == 0:
-            continue
+    # Generate new index content
+    index_content = zip(itertools.repeat(scan.patient_id), featurization.index)
 
-        # Generate new index content
-        index_content = zip(itertools.repeat(scan.patient_id), featurization.index)
+    # Add the patient id column
+    index = pd.MultiIndex.from_tuples(list(index_content), names=['patient_id', 'nodule_id'])
 
-        # Add the patient id column
-        index = pd.MultiIndex.from_tuples(index_content, names=['patient_id', 'nodule_id'])
+    # Apply new index
+    featurization.index = index
 
-        # Apply new index
-        featurization.index = index
+    return patient_id, featurization
 
-        # Store featurization for scan
-        featurizations.append(featurization)
 
-    # Combine featurizations
-    data = pd.concat(featurizations)
+def get_patient_tasks(patient_paths, cubify, estimates=None):
+    """
+    Create a `PatientTask` for each patient ID and path in `patient_paths`, estimating the memory
+    required to featurize each scan (see `get_scan_memory`). Returns the tasks ordered from the
+    largest to the smallest scan.
+    """
+    # Tasks placeholder
+    tasks = []
+
+    # For each patient
+    for patient_id, path in patient_paths:
+        memory = get_scan_memory(patient_id, path, cubify, estimates)
+        tasks.append(PatientTask(patient_id, path, memory))
 
-    # Write data to file
-    data.to_csv(destination_file)
+    # Order from largest to smallest (ties by patient ID)
+    return sorted(tasks, key=lambda task: (-task.memory, task.patient_id))
 
 
-def generate_patient_paths(data_folder):
+def get_scan_memory(patient_id, path, cubify, estimates=None):
     """
-    Yield a patient ID and path for each patient folder in data_folder.
+    Return the memory required to featurize the scan of the patient `patient_id` at `path`, taken
+    from `estimates` (a dictionary by patient ID) if available, or estimated from the size of its
+    files otherwise.
     """
-    # For every filename in data_folder
-    for filename in os.listdir(data_folder):
-        # Generate full path
-        filepath = os.path.join(data_folder, filename)
+    if estimates is not None and patient_id in estimates:
+        return estimates[patient_id]
+
+    return estimate_scan_memory(path, cubify)
 
-        # Make sure it's a folder
-        if not os.path.isdir(filepath):
-            continue
 
-        # Perform regex matching
-        match = PATIENT_FOLDER_RE.match(filename)
+def get_catalog_estimates(entries, cubify):
+    """
+    Estimate the memory required to load and featurize the scan of each of the given
+    `lcat.loading.catalog.CatalogEntry`s (resampled to cubic voxels if `cubify` is true) from its
+    dimensions. Returns a dictionary by patient ID (omitting patients whose headers couldn't be
+    read).
+    """
+    # Estimates placeholder
+    estimates = {}
 
-        # Reject improperly named folders
-        if match is None:
+    # For each readable patient
+    for entry in entries:
+        if entry.voxel_count is None:
             continue
 
-        # Yield patient ID and path
-        yield match.group(1), filepath
+        # Account for resampling (the smallest spacing is preserved)
+        voxel_count = entry.voxel_count
+        spacing = [entry.x_spacing, entry.y_spacing, entry.z_spacing]
+        if cubify and None not in spacing:
+            voxel_count *= np.prod(spacing) / min(spacing) ** len(spacing)
+
+        # Estimate memory use
+        estimates[entry.patient_id] = int(voxel_count * MEMORY_PER_VOXEL)
+
+    return estimates
+
+
+def estimate_scan_memory(path, cubify):
+    """
+    Estimate the memory required to load and featurize the scan at `path` (resampled to cubic
+    voxels if `cubify` is true) from the size of its files.
+    """
+    # Measure scan files
+    size = sum(os.path.getsize(os.path.join(folder, filename))
+               for folder, _, filenames in os.walk(path) for filename in filenames)
+
+    # Estimate memory use
+    memory = size * MEMORY_PER_SCAN_BYTE
+    if cubify:
+        memory *= CUBIFY_MEMORY_FACTOR
+
+    return memory
+
+
+def prefetch_scans(patient_paths, cubify, depth, memory_budget=None, estimates=None):
+    """
+    Load the scans of the patients in `patient_paths` (in order) on a background thread, keeping up
+    to `depth` scans loaded ahead of the scan currently being processed. If `memory_budget` (in
+    bytes) is given, scans are only loaded ahead while the estimated memory of the current and all
+    loaded scans stays within the budget. Yields the patient ID and scan (see `load_patient_scan`)
+    of each patient. A scan is considered released once the consumer requests the next one. The
+    memory of each scan is estimated using `get_scan_memory` (with `estimates`).
+    """
+    # Loaded scans and loader state (guarded by `condition`)
+    loaded = queue.Queue()
+    condition = threading.Condition()
+    state = {'count': 0, 'memory': 0, 'stopped': False}
+
+    def load_scans():
+        """
+        Load scans while the prefetch depth and memory budget allow.
+        """
+        for patient_id, path in patient_paths:
+            # Wait for room (the first scan is always loaded)
+            memory = get_scan_memory(patient_id, path, cubify, estimates)
+            with condition:
+                while not state['stopped'] and state['count'] > 0 and (
+                        state['count'] > depth or (memory_budget is not None and
+                                                   state['memory'] + memory > memory_budget)):
+                    condition.wait()
+                if state['stopped']:
+                    return
+                state['count'] += 1
+                state['memory'] += memory
+
+            # Load the scan
+            loaded.put((patient_id, load_patient_scan(patient_id, path, cubify), memory))
+
+    # Start the loader
+    loader = threading.Thread(target=load_scans)
+    loader.daemon = True
+    loader.start()
+
+    try:
+        for _ in patient_paths:
+            # Hand out the next scan
+            patient_id, scan, memory = loaded.get()
+            yield patient_id, scan
+            del scan
+
+            # Release it
+            with condition:
+                state['count'] -= 1
+                state['memory'] -= memory
+                condition.notify()
+    finally:
+        # Stop the loader
+        with condition:
+            state['stopped'] = True
+            condition.notify()
+
+
+def featurize_in_pool(tasks, options, workers, memory_budget=None):
+    """
+    Featurize the patients of the `PatientTask`s in `tasks` (in order of preference) using a pool
+    of `workers` processes. If `memory_budget` (in bytes) is given, a task is only started while
+    the estimated memory of all running tasks stays within the budget (a task is always started if
+    no other task is running). Yields the patient ID and featurization (see `featurize_patient`) of
+    each patient as it completes.
+    """
+    # Set up the pool
+    pool = multiprocessing.Pool(workers)
+    completed = queue.Queue()
+
+    try:
+        # Pending and running tasks placeholders
+        pending = list(tasks)
+        running = {}
+
+        # Until all tasks are done
+        while pending or running:
+            # Start the first pending tasks which fit in the budget
+            while pending and len(running) < workers:
+                # Determine available memory
+                available = None
+                if memory_budget is not None and running:
+                    available = memory_budget - sum(memory for memory, _ in running.values())
+
+                # Find the first (largest) task that fits
+                fitting = [index for index, task in enumerate(pending)
+                           if available is None or task.memory <= available]
+                if not fitting:
+                    break
+
+                # Start the task
+                task = pending.pop(fitting[0])
+                result = pool.apply_async(featurize_patient, (task.patient_id, task.path, options),
+                                          callback=completed.put)
+                running[task.patient_id] = (task.memory, result)
+
+            # Wait for a task to complete
+            while True:
+                try:
+                    patient_id, featurization = completed.get(timeout=POOL_POLL_INTERVAL)
+                    break
+                except queue.Empty:
+                    # Propagate errors which prevent a task from reporting back
+                    for _, result in running.values():
+                        if result.ready() and not result.successful():
+                            result.get()
+            del running[patient_id]
+
+            yield patient_id, featurization
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def get_settings(options):
+    """
+    Describe the settings affecting the featurization results of a run with the given
+    `FeaturizationOptions` (as a JSON-compatible dictionary).
+    """
+    registry = lcat.featurization.registry
+    featurizer_names = registry.get_featurizer_names(options.featurizer_names)
+
+    return {
+        'featurizers': [[featurizer_name, registry.FEATURIZER_VERSIONS[featurizer_name],
+                         registry.get_product_versions(featurizer_name)]
+                        for featurizer_name in featurizer_names],
+        'cubify': bool(options.cubify),
+    }
+
+
+def prepare_parts_folder(parts_folder, options):
+    """
+    Prepare `parts_folder` for a run with the given `FeaturizationOptions`. Returns the set of
+    patient IDs completed by a previous run with the same settings. Parts written with different
+    settings are discarded.
+    """
+    # Compare settings with the previous run
+    settings = get_settings(options)
+    settings_path = os.path.join(parts_folder, SETTINGS_FILENAME)
+    try:
+        with open(settings_path) as settings_file:
+            previous_settings = json.load(settings_file)
+    except (IOError, OSError, ValueError):
+        previous_settings = None
+
+    # Start over if the settings changed
+    if previous_settings != settings:
+        if os.path.isdir(parts_folder):
+            shutil.rmtree(parts_folder)
+        os.makedirs(parts_folder)
+        with open(settings_path, 'w') as settings_file:
+            json.dump(settings, settings_file)
+        return set()
+
+    # Read completed patients from the manifest (ignoring a partially written last line)
+    completed = set()
+    manifest_path = os.path.join(parts_folder, MANIFEST_FILENAME)
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as manifest_file:
+            for line in manifest_file:
+                try:
+                    completed.add(json.loads(line)['patient_id'])
+                except (ValueError, KeyError):
+                    continue
+
+    return completed
+
+
+def get_part_path(parts_folder, patient_id):
+    """
+    Return the path of the featurization file of the patient `patient_id` in `parts_folder`.
+    """
+    return os.path.join(parts_folder, '%s.csv' % patient_id)
+
+
+def write_part(parts_folder, patient_id, featurization):
+    """
+    Write the featurization of the patient `patient_id` to `parts_folder` and record the patient
+    as completed in the manifest. Patients without nodules are recorded without a file.
+    """
+    # Atomically write the featurization
+    if len(featurization) > 0:
+        handle, temporary_path = tempfile.mkstemp(dir=parts_folder, suffix='.tmp')
+        with os.fdopen(handle, 'w') as temporary_file:
+            featurization.to_csv(temporary_file)
+        replace = getattr(os, 'replace', os.rename)
+        replace(temporary_path, get_part_path(parts_folder, patient_id))
+
+    # Record the patient as completed
+    with open(os.path.join(parts_folder, MANIFEST_FILENAME), 'a') as manifest_file:
+        manifest_file.write(json.dumps({'patient_id': patient_id,
+                                        'rows': len(featurization)}) + '\n')
+        manifest_file.flush()
+        os.fsync(manifest_file.fileno())
+
+
+def merge_parts(parts_folder, patient_ids, destination_file):
+    """
+    Concatenate the featurization files of the given `patient_ids` (in order) from `parts_folder`
+    into `destination_file`, streaming each file rather than loading it. Patients lacking some of
+    the columns of other patients (because some of their featurizers failed) are written with
+    empty (NaN) values in those columns.
+    """
+    # Find featurization files
+    part_paths = [get_part_path(parts_folder, patient_id) for patient_id in patient_ids]
+    part_paths = [part_path for part_path in part_paths if os.path.exists(part_path)]
+
+    # Combine the columns of all parts
+    part_headers = [read_part_header(part_path) for part_path in part_paths]
+    header = []
+    for part_header in part_headers:
+        header = merge_columns(header, part_header)
+
+    with open(destination_file, 'w') as destination:
+        writer = csv.writer(destination, lineterminator='\n')
+        writer.writerow(header)
+
+        # For each patient with a featurization
+        for part_path, part_header in zip(part_paths, part_headers):
+            with open(part_path) as part_file:
+                # Copy rows of parts with all columns
+                if part_header == header:
+                    part_file.readline()
+                    shutil.copyfileobj(part_file, destination)
+                    continue
+
+                # Rearrange rows of parts lacking columns
+                reader = csv.reader(part_file)
+                next(reader)
+                positions = dict((column, index) for index, column in enumerate(part_header))
+                for row in reader:
+                    writer.writerow([row[positions[column]] if column in positions else ''
+                                     for column in header])
+
+
+def read_part_header(part_path):
+    """
+    Return the column names (including index names) of the featurization file `part_path`.
+    """
+    with open(part_path) as part_file:
+        return next(csv.reader(part_file))
+
+
+def merge_columns(columns, new_columns):
+    """
+    Return `columns` with the columns of `new_columns` which are missing inserted after the column
+    preceding them in `new_columns` (so that columns remain in featurizer order).
+    """
+    merged = list(columns)
+    position = 0
+    for column in new_columns:
+        if column in merged:
+            position = merged.index(column) + 1
+        else:
+            merged.insert(position, column)
+            position += 1
+
+    return merged
 
 
 def main():
@@ -100,12 +541,79 @@ def main():
                         help="Folder containing LIDC-IDRI data.")
     parser.add_argument('destination_file', metavar="destination-file",
                         help="Destination CSV file for featurization.")
+    parser.add_argument('--featurizers', metavar="featurizer", nargs='+', default=None,
+                        choices=sorted(lcat.featurization.registry.FEATURIZERS),
+                        help="Featurizers to run (defaults to all featurizers).")
+    parser.add_argument('--cache-folder', metavar="cache-folder", default=None,
+                        help="Folder for persistent caching of intermediate results and "
+                             "featurizer results (shared between runs and worker processes). "
+                             "Only stale or missing featurizer results are recomputed.")
+    parser.add_argument('--cubify', action='store_true',
+                        help="Resample scans to cubic voxels before featurization (by default, "
+                             "scans are featurized on their native grid).")
+    parser.add_argument('--featurizer-concurrency', metavar="count", type=int, default=1,
+                        help="Maximum number of featurizers to run at once on each scan.")
+    parser.add_argument('--featurizer-processes', action='store_true',
+                        help="Run concurrent featurizers in separate processes instead of "
+                             "threads.")
+    parser.add_argument('--workers', metavar="count", type=int, default=1,
+                        help="Number of processes featurizing patients in parallel.")
+    parser.add_argument('--memory-budget', metavar="gigabytes", type=float, default=None,
+                        help="Approximate memory available to each worker process (in GB). "
+                             "Large scans are only started while the estimated memory use of "
+                             "running scans fits in the combined budget. Also limits the "
+                             "scans loaded ahead using --prefetch.")
+    parser.add_argument('--prefetch', metavar="count", type=int, default=0,
+                        help="Number of scans loaded in the background ahead of the scan being "
+                             "featurized (without --workers).")
+    parser.add_argument('--catalog', metavar="catalog-file", default=None,
+                        help="SQLite catalog of the scan folder (created or updated by reading "
+                             "only the headers of new or changed patients), used to list "
+                             "patients and estimate scan sizes.")
+    parser.add_argument('--trace', metavar="trace-file", default=None,
+                        help="JSON lines file receiving the wall time, CPU time and peak memory "
+                             "of each loading, segmentation, analysis and featurizer stage of "
+                             "each patient (from all processes).")
+    parser.add_argument('--chrome-trace', metavar="trace-file", default=None,
+                        help="File receiving the stage timings in the Chrome trace format "
+                             "(viewable using chrome://tracing or Perfetto).")
+    parser.add_argument('--trace-memory', action='store_true',
+                        help="Also record the peak memory allocated by each stage using "
+                             "tracemalloc (slows down featurization).")
 
     # Parse arguments
     args = parser.parse_args()
 
+    # Configure caching (through the environment, so that it is inherited by subprocesses)
+    if args.cache_folder is not None:
+        os.environ[lcat.cache.CACHE_FOLDER_VARIABLE] = args.cache_folder
+
+    # Convert memory budget to bytes
+    memory_budget = None
+    if args.memory_budget is not None:
+        memory_budget = int(args.memory_budget * 1024 ** 3)
+
+    # Configure instrumentation (through the environment, so that it is inherited by subprocesses)
+    trace_file = args.trace
+    if trace_file is None and args.chrome_trace is not None:
+        descriptor, trace_file = tempfile.mkstemp(suffix='.jsonl')
+        os.close(descriptor)
+    if trace_file is not None:
+        lcat.instrumentation.enable(trace_file, trace_memory=args.trace_memory)
+
     # Test bronchi segmentation code
-    execute(args.data_folder, args.destination_file)
+    options = FeaturizationOptions(args.featurizers, args.featurizer_concurrency,
+                                   args.featurizer_processes, args.cubify)
+    try:
+        execute(args.data_folder, args.destination_file, options, args.workers, memory_budget,
+                args.prefetch, args.catalog)
+    finally:
+        # Convert the trace
+        if args.chrome_trace is not None:
+            records = lcat.instrumentation.load_records(trace_file)
+            lcat.instrumentation.write_chrome_trace(records, args.chrome_trace)
+            if args.trace is None:
+                os.remove(trace_file)
 
 
 if __name__ == '__main__':
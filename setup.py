@@ -17,14 +17,17 @@ DEPENDENCIES = [
 
 PACKAGES = ['lcat',
             'lcat.analysis',
+            'lcat.featurization',
             'lcat.loading',
-            'lcat.segmentation']
+            'lcat.segmentation',
+            'lcat.synthetic']
 
 PACKAGE_DIR = {}
 
 PACKAGE_DATA = {}
 
-SCRIPTS = ['scripts/lcat-featurize.py',
+SCRIPTS = ['scripts/lcat-benchmark.py',
+           'scripts/lcat-featurize.py',
            'scripts/lcat-visualize.py']
 
 setup(name='lcat',
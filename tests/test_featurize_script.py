@@ -0,0 +1,53 @@
+"""
+Tests of the lcat-featurize.py script.
+"""
+import os
+import runpy
+
+import numpy as np
+import pandas as pd
+
+
+# Path of the featurization script
+SCRIPT_PATH = os.path.join(os.path.dirname(__file__), os.pardir, 'scripts', 'lcat-featurize.py')
+
+# Featurization script module namespace
+featurize = runpy.run_path(SCRIPT_PATH)
+
+
+def make_featurization(patient_id, nodule_ids, columns):
+    """
+    Create a featurization of the patient `patient_id` with the given `nodule_ids` and `columns`.
+    """
+    index = pd.MultiIndex.from_tuples([(patient_id, nodule_id) for nodule_id in nodule_ids],
+                                      names=['patient_id', 'nodule_id'])
+    values = np.arange(len(nodule_ids) * len(columns), dtype=float)
+    return pd.DataFrame(values.reshape(len(nodule_ids), len(columns)), index=index,
+                        columns=columns)
+
+
+def test_merge_parts_with_failed_featurizer(tmpdir):
+    """
+    Patients whose featurizers failed are merged with NaN in the missing columns.
+    """
+    parts_folder = str(tmpdir.mkdir('parts'))
+    destination_file = str(tmpdir.join('features.csv'))
+
+    # The shape featurizer failed for the second patient only
+    featurize['write_part'](parts_folder, '0001',
+                            make_featurization('0001', ['a', 'b'], ['center_x', 'volume', 'z']))
+    featurize['write_part'](parts_folder, '0002',
+                            make_featurization('0002', ['c', 'd', 'e'], ['center_x', 'z']))
+    featurize['write_part'](parts_folder, '0003',
+                            make_featurization('0003', ['f'], ['center_x', 'volume', 'z']))
+
+    # Merge parts
+    featurize['merge_parts'](parts_folder, ['0001', '0002', '0003'], destination_file)
+    merged = pd.read_csv(destination_file, index_col=[0, 1], dtype={'nodule_id': str})
+
+    # All patients and columns are present, in order
+    assert list(merged.columns) == ['center_x', 'volume', 'z']
+    assert list(merged.index.get_level_values('nodule_id')) == ['a', 'b', 'c', 'd', 'e', 'f']
+    assert merged['volume'].isnull().sum() == 3
+    assert list(merged['z'].iloc[2:5]) == [1.0, 3.0, 5.0]
+    assert list(merged['z'].iloc[:2]) == [2.0, 5.0]